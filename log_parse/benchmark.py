@@ -0,0 +1,104 @@
+import os
+import re
+import time
+import random
+import argparse
+import tempfile
+from functools import partial
+from urllib.parse import urlparse
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+from log_parse import parse, log_pattern
+
+HOSTS = ['mail.ru', 'www.mail.ru', 'corp.mail.ru', 'www.corp.mail.ru', 'sys.mail.ru', 'e.mail.ru']
+PATHS = ['/', '/inbox', '/static/css/reset.css', '/static/js/app.js', '/img/logo.png', '/api/v1/messages']
+REQUEST_TYPES = ['GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE']
+
+PARAMS = [
+    {},
+    {'ignore_files': True, 'ignore_www': True, 'request_type': 'GET'},
+    {'start_at': datetime(2018, 3, 20, 12), 'stop_at': datetime(2018, 3, 22, 6), 'slow_queries': True},
+]
+
+
+def write_log(path, lines_count, urls_count):
+    """a log of lines_count requests to urls_count distinct urls"""
+    random.seed(0)
+    urls = ['https://{}{}{}'.format(random.choice(HOSTS), random.choice(PATHS), random.randrange(urls_count))
+            for _ in range(urls_count)]
+    started_at = datetime(2018, 3, 19)
+    with open(path, 'w') as log_file:
+        for _ in range(lines_count):
+            log_file.write('[{:%d/%b/%Y %H:%M:%S}] "{} {} HTTP/1.1" {} {}\n'.format(
+                started_at + timedelta(seconds=random.randrange(5 * 24 * 3600)), random.choice(REQUEST_TYPES),
+                random.choice(urls), random.choice((200, 301, 404, 500)), random.randrange(100000)))
+
+
+def reference_parse(ignore_files=False, ignore_urls=(), start_at=None, stop_at=None, request_type=None,
+                    ignore_www=False, slow_queries=False, log='log.log'):
+    """the former per line path: a regex match, several urlparse and strptime calls for every line"""
+    out_log = defaultdict(lambda: [0, 0])
+    for line in open(log):
+        match = re.match(log_pattern, line)
+        if not match:
+            continue
+        match_dict = match.groupdict()
+        log_url = urlparse(match_dict['request']).netloc + urlparse(match_dict['request']).path
+        if start_at or stop_at:
+            log_date = datetime.strptime(match_dict['request_date'], '%d/%b/%Y %H:%M:%S')
+            if stop_at and log_date > stop_at or start_at and log_date < start_at:
+                continue
+        if request_type and request_type != match_dict['request_type']:
+            continue
+        if ignore_files and re.match('.+\.[^./]*$', urlparse(match_dict['request']).path):
+            continue
+        if log_url in ignore_urls:
+            continue
+        if ignore_www and urlparse(match_dict['request']).netloc.startswith('www.'):
+            out_log[log_url[4:]][0] += 1
+            continue
+        out_log[log_url][0] += 1
+        out_log[log_url][1] += int(match_dict['response_time'])
+
+    if slow_queries:
+        return sorted((total // count for count, total in out_log.values()), reverse=True)[:5]
+    return sorted((count for count, total in out_log.values()), reverse=True)[:5]
+
+
+def measure(function, params, log_path, lines_count):
+    started_at = time.perf_counter()
+    result = function(log=log_path, **params)
+    return result, lines_count / (time.perf_counter() - started_at)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='log_parse throughput on a synthetic log')
+    parser.add_argument('--lines', type=int, default=200000, help='lines in the log')
+    parser.add_argument('--urls', type=int, default=10000, help='distinct urls in the log')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes of the parallel mode')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, 'log.log')
+        write_log(log_path, args.lines, args.urls)
+
+        for params in PARAMS:
+            expected, reference_speed = measure(reference_parse, params, log_path, args.lines)
+            result, speed = measure(parse, params, log_path, args.lines)
+            assert result == expected, (params, result, expected)
+            print('{}: {:.0f} -> {:.0f} lines/s, x{:.1f}'.format(params or 'no filters', reference_speed, speed,
+                                                                 speed / reference_speed))
+
+            result, mmap_speed = measure(partial(parse, use_mmap=True), params, log_path, args.lines)
+            assert result == expected, (params, result, expected)
+            print('    mmap: {:.0f} lines/s, x{:.1f}'.format(mmap_speed, mmap_speed / reference_speed))
+
+            result, parallel_speed = measure(partial(parse, workers=args.workers), params, log_path, args.lines)
+            assert result == expected, (params, result, expected)
+            print('    {} workers: {:.0f} lines/s, x{:.1f}'.format(args.workers, parallel_speed,
+                                                                 parallel_speed / reference_speed))
+
+
+if __name__ == '__main__':
+    main()
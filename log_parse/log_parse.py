@@ -1,80 +1,365 @@
-﻿import re
+﻿import io
+import os
+import re
+import bz2
+import mmap
+import gzip
+import heapq
+import locale
+import functools
+import multiprocessing
 from urllib.parse import urlparse
 from datetime import datetime
 from collections import defaultdict
 
+log_pattern = re.compile('\[(?P<request_date>.+)\] '
+                         '"(?P<request_type>.+) (?P<request>.+) (?P<protocol>.+)" '
+                         '(?P<response_code>\d+) '
+                         '(?P<response_time>\d+)\n')
+# the same pattern searched for in the bytes of a whole file, a line is matched starting at its beginning only
+log_bytes_pattern = re.compile(rb'^\[(?P<request_date>.+)\] '
+                               rb'"(?P<request_type>.+) (?P<request>.+) (?P<protocol>.+)" '
+                               rb'(?P<response_code>\d+) '
+                               rb'(?P<response_time>\d+)\n', re.MULTILINE)
+# lines without spaces in the request and without ] in the date match log_bytes_pattern in a single way,
+# this pattern finds them without backtracking
+simple_line_pattern = re.compile(rb'^\[(?P<request_date>[^]\n]+)\] '
+                                 rb'"(?P<request_type>[^ \n]+) (?P<request>[^ \n]+) (?P<protocol>[^ "\n]+)" '
+                                 rb'(?P<response_code>\d+) '
+                                 rb'(?P<response_time>\d+)\n', re.MULTILINE)
+file_pattern = re.compile('.+\.[^./]*$')
 
-def parse(ignore_files=False,
-          ignore_urls=False,
-          start_at=None,
-          stop_at=None,
-          request_type=None,
-          ignore_www=False,
-          slow_queries=False):
-    if ignore_urls is False:
-        ignore_urls = []
+# requests whose parsed urls are kept, a log with unique query strings does not grow the cache
+URL_CACHE_SIZE = 10000
 
-    with open('log.log') as log_file:
-        log = log_file.readlines()
+MONTHS = {month: number for number, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
 
-    log_pattern = re.compile('\[(?P<request_date>.+)\] '
-                             '"(?P<request_type>.+) (?P<request>.+) (?P<protocol>.+)" '
-                             '(?P<response_code>\d+) '
-                             '(?P<response_time>\d+)\n')
 
-    out_log = defaultdict(lambda: [0, 0])
+def open_log(path):
+    """opens a plain, gzip or bz2 compressed log as text"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt')
+    return open(path)
+
+
+def read_lines(log):
+    """yields lines of a log given as a path, a file object or an iterable of lines"""
+    if isinstance(log, (str, os.PathLike)):
+        with open_log(os.fspath(log)) as log_file:
+            yield from log_file
+        return
+
+    if isinstance(log, (io.RawIOBase, io.BufferedIOBase)):
+        # a file opened in binary mode is decoded like open() decodes it: the same encoding and universal newlines
+        log_file = io.TextIOWrapper(log)
+        try:
+            yield from log_file
+        finally:
+            # the file belongs to the caller, it is not closed with the wrapper
+            log_file.detach()
+        return
 
     for line in log:
-        match = re.match(log_pattern, line)
-        if not match:
+        if isinstance(line, bytes):
+            line = line.decode(locale.getpreferredencoding(False))
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+        yield line
+
+
+def split_line(line):
+    """fields of a well-formed line split on spaces, None if only log_pattern can tell
+
+    A line of 7 space separated parts matches log_pattern in a single way, the greedy groups can not move.
+    """
+    parts = line.split(' ')
+    if len(parts) != 7:
+        return None
+    date_start, date_end, request_type, request, protocol, response_code, response_time = parts
+    if (date_start[:1] != '[' or date_end[-1:] != ']' or request_type[:1] != '"' or len(request_type) < 2
+            or not request or protocol[-1:] != '"' or len(protocol) < 2 or not response_code.isdecimal()
+            or response_time[-1:] != '\n' or not response_time[:-1].isdecimal() or line.find('\n') != len(line) - 1):
+        return None
+    return date_start[1:] + ' ' + date_end[:-1], request_type[1:], request, response_time[:-1]
+
+
+def match_lines(lines):
+    """yields (date, request type, request, response time) of request lines, other lines are skipped"""
+    match = log_pattern.match
+    for line in lines:
+        fields = split_line(line)
+        if fields:
+            yield fields
             continue
-        match_dict = match.groupdict()
+        line_match = match(line)
+        if line_match:
+            yield line_match.group('request_date', 'request_type', 'request', 'response_time')
+
+
+def scan_lines(buffer, start, stop):
+    """yields (date, request type, request, response time) as bytes of request lines in a part of a buffer
+
+    Lines are neither split nor decoded, only the groups of the found lines are copied.
+    """
+    position = start
+    for line_match in simple_line_pattern.finditer(buffer, start, stop):
+        # lines skipped by the simple pattern may still be requests
+        if line_match.start() > position:
+            for gap_match in log_bytes_pattern.finditer(buffer, position, line_match.start()):
+                yield gap_match.group('request_date', 'request_type', 'request', 'response_time')
+        yield line_match.group('request_date', 'request_type', 'request', 'response_time')
+        position = line_match.end()
 
-        log_url = urlparse(match_dict['request']).netloc + urlparse(match_dict['request']).path
+    for gap_match in log_bytes_pattern.finditer(buffer, position, stop):
+        yield gap_match.group('request_date', 'request_type', 'request', 'response_time')
+
+
+def parse_date(date):
+    """the same as datetime.strptime(date, '%d/%b/%Y %H:%M:%S') for dates in the log layout, but much faster"""
+    month = MONTHS.get(date[3:6])
+    if (len(date) != 20 or month is None or date[2] + date[6] + date[11] + date[14] + date[17] != '// ::'
+            or not (date[:2] + date[7:11] + date[12:14] + date[15:17] + date[18:]).isdecimal()):
+        return datetime.strptime(date, '%d/%b/%Y %H:%M:%S')
+    return datetime(int(date[7:11]), month, int(date[:2]), int(date[12:14]), int(date[15:17]), int(date[18:]))
+
+
+def get_url(request, ignore_files, ignore_urls, ignore_www):
+    """(url, is www request) of a request, None if the request is filtered out"""
+    parsed_request = urlparse(request)
+    log_url = parsed_request.netloc + parsed_request.path
+
+    if ignore_files and file_pattern.match(parsed_request.path):
+        return None
+    if log_url in ignore_urls:
+        return None
+    if ignore_www and parsed_request.netloc.startswith('www.'):
+        return log_url[4:], True
+    return log_url, False
+
+
+def select_requests(requests,
+                    ignore_files=False,
+                    ignore_urls=(),
+                    start_at=None,
+                    stop_at=None,
+                    request_type=None,
+                    ignore_www=False,
+                    encoding=None):
+    """yields (url, response time) of requests passing the filters
+
+    Cheap string filters go first. Parsed urls of the last URL_CACHE_SIZE distinct request strings are cached,
+    logs have far fewer distinct requests than lines.
+    Fields are bytes if encoding is given, they are decoded only when they can not be compared as bytes.
+    """
+    ignore_urls = set(ignore_urls)
+    if encoding and request_type:
+        request_type = request_type.encode(encoding)
+
+    @functools.lru_cache(maxsize=URL_CACHE_SIZE)
+    def get_cached_url(log_request):
+        return get_url(log_request.decode(encoding) if encoding else log_request,
+                       ignore_files, ignore_urls, ignore_www)
+
+    for log_date, log_request_type, log_request, response_time in requests:
+        # check request type
+        if request_type and request_type != log_request_type:
+            continue
 
         # check dates
         if start_at or stop_at:
-            log_date = datetime.strptime(match_dict['request_date'], '%d/%b/%Y %H:%M:%S')
+            log_date = parse_date(log_date.decode(encoding) if encoding else log_date)
             if stop_at and log_date > stop_at:
                 continue
             if start_at and log_date < start_at:
                 continue
 
-        # check request type
-        if request_type:
-            if request_type != match_dict['request_type']:
-                continue
-
-        # check ignore files
-        if ignore_files:
-            log_request = urlparse(match_dict['request'])
-            match_file = re.match('.+\.[^./]*$', log_request.path)
-            if match_file:
-                continue
+        # check ignore files and ignore URLs, strip www
+        url = get_cached_url(log_request)
+        if url is None:
+            continue
 
-        # check ignore URLs
-        if ignore_urls:
-            if log_url in ignore_urls:
-                continue
+        # only the count of www requests is taken into account
+        log_url, is_www = url
+        yield log_url, 0 if is_www else int(response_time)
 
-        # check ignore www
-        if ignore_www:
-            log_host = urlparse(match_dict['request']).netloc
-            if log_host.startswith('www.'):
-                out_log[log_url[4:]][0] += 1
-                continue
 
-        # count other logs
+def count_requests(requests):
+    """{url: [count, sum of response times]}, memory depends on the number of urls only"""
+    out_log = defaultdict(lambda: [0, 0])
+    for log_url, response_time in requests:
         out_log[log_url][0] += 1
+        out_log[log_url][1] += response_time
+    return out_log
 
-        # count sum response time for URLs
-        out_log[log_url][1] += int(match_dict['response_time'])
 
-    if slow_queries:
-        sorted_out_log = sorted(out_log.items(), key=lambda i: i[1][1] // i[1][0], reverse=True)
-        result = [element[1][1] // element[1][0] for element in sorted_out_log[:5]]
+def merge_counts(out_logs):
+    """sums {url: [count, sum of response times]} of parts of a log"""
+    out_log = defaultdict(lambda: [0, 0])
+    for part_out_log in out_logs:
+        for log_url, (count, total) in part_out_log.items():
+            out_log[log_url][0] += count
+            out_log[log_url][1] += total
+    return out_log
+
+
+def reduce_counts(counts, max_urls):
+    """subtracts the (max_urls + 1)-th largest count from every count, at most max_urls urls are left
+
+    Returns the subtracted value.
+    """
+    decrement = heapq.nlargest(max_urls + 1, counts.values())[-1]
+    for log_url in list(counts):
+        counts[log_url] -= decrement
+        if counts[log_url] <= 0:
+            del counts[log_url]
+    return decrement
+
+
+def count_frequent(requests, max_urls):
+    """({url: count}, error) of the most frequent urls, memory is bounded by max_urls (Misra-Gries summary)
+
+    A true count is in [count, count + error], urls missing from the result are requested at most error times.
+    A reduction subtracts its value from at least max_urls + 1 counts, so error <= requests / (max_urls + 1).
+    """
+    counts = defaultdict(int)
+    error = 0
+    for log_url, response_time in requests:
+        counts[log_url] += 1
+        # reductions are batched, between them at most 2 * max_urls urls are counted
+        if len(counts) >= 2 * max_urls:
+            error += reduce_counts(counts, max_urls)
+    return dict(counts), error
+
+
+def merge_frequent(summaries, max_urls):
+    """merges ({url: count}, error) of parts of a log, errors of the parts add up"""
+    counts = defaultdict(int)
+    error = 0
+    for part_counts, part_error in summaries:
+        for log_url, count in part_counts.items():
+            counts[log_url] += count
+        error += part_error
+    if len(counts) > max_urls:
+        error += reduce_counts(counts, max_urls)
+    return counts, error
+
+
+def count(requests, max_urls):
+    """exact counts of requests, approximate counts with max_urls"""
+    if max_urls:
+        return count_frequent(requests, max_urls)
+    return dict(count_requests(requests))
+
+
+class RangeReader(io.RawIOBase):
+    """bytes of a file from start to stop"""
+
+    def __init__(self, path, start, stop):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._left = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(min(len(buffer), self._left))
+        buffer[:len(data)] = data
+        self._left -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def split_log(path, parts_count):
+    """(start, stop) byte ranges of a log, every range starts at a line beginning"""
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as log_file:
+        for part in range(1, parts_count):
+            log_file.seek(max(size * part // parts_count - 1, offsets[-1]))
+            # a range ends right after a newline, so a \r\n pair or a multi byte character is never split
+            log_file.readline()
+            offsets.append(log_file.tell())
+    offsets.append(size)
+    return [(start, stop) for start, stop in zip(offsets, offsets[1:]) if start < stop]
+
+
+def count_range(path, start, stop, filters, use_mmap=False, max_urls=None):
+    """counts of a part of a log, run in a worker process with workers > 1"""
+    if use_mmap and start < stop:
+        with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # text mode turns a lone \r into a line end, the bytes pattern would not
+            if buffer.find(b'\r', start, stop) == -1:
+                requests = scan_lines(buffer, start, stop)
+                try:
+                    return count(select_requests(requests, encoding=locale.getpreferredencoding(False), **filters),
+                                 max_urls)
+                finally:
+                    # the scanner refers to the buffer, the map can not be closed while it is alive
+                    requests.close()
+
+    # the range is decoded like open() decodes the whole file: the same encoding and universal newlines
+    with io.TextIOWrapper(io.BufferedReader(RangeReader(path, start, stop))) as log_file:
+        return count(select_requests(match_lines(log_file), **filters), max_urls)
+
+
+def count_parallel(path, workers, filters, use_mmap, max_urls):
+    with multiprocessing.Pool(workers) as pool:
+        counts = pool.starmap(count_range, [(path, start, stop, filters, use_mmap, max_urls)
+                                            for start, stop in split_log(path, workers)])
+    if max_urls:
+        return merge_frequent(counts, max_urls)
+    return merge_counts(counts)
+
+
+def parse(ignore_files=False,
+          ignore_urls=False,
+          start_at=None,
+          stop_at=None,
+          request_type=None,
+          ignore_www=False,
+          slow_queries=False,
+          log='log.log',
+          workers=1,
+          use_mmap=False,
+          top=5,
+          max_urls=None):
+    """log is a path to a plain, .gz or .bz2 file, a file object or an iterable of lines
+
+    With workers > 1 a plain file is split into ranges parsed by a pool of processes,
+    other logs are parsed serially.
+    With use_mmap a plain file is mapped to memory and searched for request lines as bytes,
+    the file encoding must be ASCII compatible.
+    With max_urls memory does not grow with the number of distinct urls, but counts are approximate:
+    (count, error) pairs are returned, a true count is in [count, count + error].
+    """
+    if max_urls and slow_queries:
+        raise ValueError('Average response times can not be approximated')
+    if ignore_urls is False:
+        ignore_urls = []
+    filters = dict(ignore_files=ignore_files, ignore_urls=ignore_urls, start_at=start_at, stop_at=stop_at,
+                   request_type=request_type, ignore_www=ignore_www)
+
+    is_plain_file = isinstance(log, (str, os.PathLike)) and not os.fspath(log).endswith(('.gz', '.bz2'))
+    if is_plain_file and workers > 1:
+        out_log = count_parallel(os.fspath(log), workers, filters, use_mmap, max_urls)
+    elif is_plain_file and use_mmap:
+        out_log = count_range(os.fspath(log), 0, os.path.getsize(log), filters, use_mmap, max_urls)
     else:
-        sorted_out_log = sorted(out_log.items(), key=lambda i: i[1][0], reverse=True)
-        result = [element[1][0] for element in sorted_out_log[:5]]
+        # lines are read one by one through the generators, the log is never in memory as a whole
+        out_log = count(select_requests(match_lines(read_lines(log)), **filters), max_urls)
 
-    return result
+    if max_urls:
+        counts, error = out_log
+        return [(url_count, error) for url_count in heapq.nlargest(top, counts.values())]
+
+    # only the top values are kept instead of sorting all urls
+    if slow_queries:
+        return heapq.nlargest(top, (total // url_count for url_count, total in out_log.values()))
+    return heapq.nlargest(top, (url_count for url_count, total in out_log.values()))
@@ -1,21 +1,139 @@
+import os
+import bz2
+import gzip
 import json
+import shutil
+import tempfile
+import tracemalloc
 from glob import glob
-from log_parse import parse
+from log_parse import parse, read_lines, match_lines, select_requests, count_requests, count_frequent, count_parallel
 
 error_message = 'Ошибка в фаиле {}. Expected: "{}", got: "{}"'
 
 
+def compress_log(path, directory):
+    """copies of the log compressed with gzip and bz2"""
+    compressed_paths = []
+    for extension, open_compressed in [('.gz', gzip.open), ('.bz2', bz2.open)]:
+        compressed_path = os.path.join(directory, os.path.basename(path) + extension)
+        with open(path, 'rb') as log_file, open_compressed(compressed_path, 'wb') as compressed_file:
+            shutil.copyfileobj(log_file, compressed_file)
+        compressed_paths.append(compressed_path)
+    return compressed_paths
+
+
+def write_crlf_log(path, directory):
+    """copy of the log with \r\n line ends"""
+    crlf_path = os.path.join(directory, 'crlf_' + os.path.basename(path))
+    with open(path, 'rb') as log_file, open(crlf_path, 'wb') as crlf_file:
+        for line in log_file:
+            crlf_file.write(line.rstrip(b'\n') + b'\r\n')
+    return crlf_path
+
+
+def parse_log_forms(params, path, compressed_paths, crlf_path):
+    """results for the same log given as a text file, a binary file, a list of lines and compressed files,
+    with \n and with \r\n line ends"""
+    results = []
+    for log_path in [path, crlf_path]:
+        for mode in ['r', 'rb']:
+            with open(log_path, mode) as log_file:
+                results.append(parse(log=log_file, **params))
+                log_file.seek(0)
+                results.append(parse(log=log_file.readlines(), **params))
+    for compressed_path in compressed_paths:
+        results.append(parse(log=compressed_path, **params))
+        with (gzip.open if compressed_path.endswith('.gz') else bz2.open)(compressed_path) as log_file:
+            results.append(parse(log=log_file, **params))
+    return results
+
+
+def check_frequent(path):
+    """error message if top values or (count, error) pairs of max_urls disagree with exact counts, None otherwise"""
+    filters = dict(ignore_files=False, ignore_urls=[], start_at=None, stop_at=None, request_type=None,
+                   ignore_www=False)
+    exact_counts = {log_url: url_count
+                    for log_url, (url_count, total) in count_requests(
+                        select_requests(match_lines(read_lines(path)), **filters)).items()}
+    requests_count = sum(exact_counts.values())
+    exact_top = sorted(exact_counts.values(), reverse=True)
+
+    for top in [1, 3, 10]:
+        got = parse(log=path, top=top)
+        if got != exact_top[:top]:
+            return 'top={}: получен {}, ожидался {}'.format(top, got, exact_top[:top])
+
+    for max_urls in [1, 3, 50]:
+        summaries = [('serial', count_frequent(select_requests(match_lines(read_lines(path)), **filters), max_urls))]
+        summaries += [('workers=4, use_mmap={}'.format(use_mmap), count_parallel(path, 4, filters, use_mmap, max_urls))
+                      for use_mmap in [False, True]]
+        for mode, (counts, error) in summaries:
+            if error > requests_count // (max_urls + 1):
+                return 'max_urls={}, {}: error {} больше {} / {}'.format(max_urls, mode, error, requests_count,
+                                                                      max_urls + 1)
+            # urls missing from the summary have the count 0
+            for log_url, url_count in exact_counts.items():
+                if not counts.get(log_url, 0) <= url_count <= counts.get(log_url, 0) + error:
+                    return 'max_urls={}, {}: url {} запрошен {} раз, получено ({}, {})'.format(
+                        max_urls, mode, log_url, url_count, counts.get(log_url, 0), error)
+
+        # every true count is within its bounds, so are the top values, missing pairs have the count 0
+        for workers in [1, 4]:
+            got = parse(log=path, top=10, max_urls=max_urls, workers=workers)
+            for index, (url_count, error) in enumerate(got):
+                if not url_count <= exact_top[index] <= url_count + error:
+                    return 'max_urls={}, workers={}: получен {}, точные значения {}'.format(
+                        max_urls, workers, got, exact_top[:10])
+    return None
+
+
+def check_memory(directory):
+    """error message if memory of parsing with max_urls grows with the number of distinct requests, None otherwise"""
+    peaks = []
+    for lines_count in [50000, 200000]:
+        path = os.path.join(directory, 'distinct.log')
+        with open(path, 'w') as log_file:
+            for index in range(lines_count):
+                # the query strings differ, the url is the same
+                log_file.write('[23/Mar/2018 04:02:11] "GET https://sys.mail.ru/inbox?id={} HTTP/1.1" 200 100\n'
+                               .format(index))
+        tracemalloc.start()
+        parse(log=path, max_urls=10)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    if peaks[1] > peaks[0] * 1.5:
+        return 'max_urls=10: {} байт памяти на 50000 запросов, {} на 200000'.format(*peaks)
+    return None
+
+
 def run_tests():
-    for filename in glob('tests/*.json'):
-        data = json.load(open(filename))
-        params, response = data['params'], data['response']
-        got = parse(**data['params'])
-        for index, item in enumerate(response):
-            if len(got) != len(response) or got[index] != response[index]:
-                print("Полученный и ожидаемый массивы различаются, получен: {} ожидался: {}, фаили {}".format(
-                    str(got), str(response), filename
-                ))
-                return
+    with tempfile.TemporaryDirectory() as directory:
+        compressed_paths = compress_log('log.log', directory)
+        crlf_path = write_crlf_log('log.log', directory)
+        compressed_paths += compress_log(crlf_path, directory)
+        for filename in glob('tests/*.json'):
+            data = json.load(open(filename))
+            params, response = data['params'], data['response']
+            # the parallel and mmap modes must give the same result as the serial one
+            results = [parse(workers=workers, use_mmap=use_mmap, **params)
+                       for workers, use_mmap in [(1, False), (1, True), (4, False), (4, True)]]
+            # as well as every form of the log argument
+            results += parse_log_forms(params, 'log.log', compressed_paths, crlf_path)
+            for got in results:
+                for index, item in enumerate(response):
+                    if len(got) != len(response) or got[index] != response[index]:
+                        print("Полученный и ожидаемый массивы различаются, получен: {} ожидался: {}, фаили {}".format(
+                            str(got), str(response), filename
+                        ))
+                        return
+
+    error = check_frequent('log.log')
+    if error is None:
+        with tempfile.TemporaryDirectory() as directory:
+            error = check_memory(directory)
+    if error is not None:
+        print(error)
+        return
     print("All tests passed!")
 
 
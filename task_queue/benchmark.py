@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def send(port, command):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(('127.0.0.1', port))
+    s.sendall(command)
+    # the server closes the connection after the response
+    data = b''
+    while True:
+        chunk = s.recv(1000000)
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    return data
+
+
+def wait_for_server(port, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            send(port, b'GET benchmark_probe')
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Server did not start')
+
+
+def start_server(port, backup_path, *server_args, stderr=None):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    server = subprocess.Popen([sys.executable, server_path, str(port), '--backup_path', backup_path] +
+                              [str(arg) for arg in server_args], stderr=stderr)
+    wait_for_server(port)
+    return server
+
+
+def get_percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_clients(port, clients, requests_per_client, command):
+    def client():
+        for _ in range(requests_per_client):
+            send(port, command)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * requests_per_client / (time.time() - start_time)
+
+
+def group_commit_benchmark(windows, clients, requests_per_client, group_commit_size):
+    """ops/sec of ADD commands against the group commit window"""
+    results = []
+    for window in windows:
+        with tempfile.TemporaryDirectory() as backup_dir:
+            port = get_free_port()
+            server = start_server(port, os.path.join(backup_dir, 'backup.json'),
+                                  '--group_commit_window', window, '--group_commit_size', group_commit_size)
+            try:
+                ops_per_sec = run_clients(port, clients, requests_per_client, b'ADD bench 5 12345')
+            finally:
+                server.terminate()
+                server.wait()
+        results.append((window, ops_per_sec))
+        print('window {:>8.4f} s: {:>10.1f} ops/sec'.format(window, ops_per_sec))
+    return results
+
+
+class LatencyRecorder:
+    """latencies of every command kind, shared by client threads"""
+
+    def __init__(self):
+        self.latencies = {'ADD': [], 'GET': [], 'ACK': [], 'IN': []}
+        self._lock = threading.Lock()
+
+    def timed_send(self, port, command_name, command):
+        start_time = time.perf_counter()
+        response = send(port, command)
+        latency = time.perf_counter() - start_time
+        with self._lock:
+            self.latencies[command_name].append(latency)
+        return response
+
+    def report(self, duration):
+        report = {}
+        for command_name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            report[command_name] = {
+                'count': len(latencies),
+                'ops_per_sec': len(latencies) / duration,
+                'p50_ms': to_milliseconds(get_percentile(latencies, 0.5)),
+                'p99_ms': to_milliseconds(get_percentile(latencies, 0.99)),
+                'p999_ms': to_milliseconds(get_percentile(latencies, 0.999)),
+            }
+        return report
+
+
+def to_milliseconds(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def prefill_queue(port, queue_name, queue_depth, payload):
+    batch_size = 1000
+    while queue_depth > 0:
+        count = min(batch_size, queue_depth)
+        items = b' '.join(str(len(payload)).encode('utf8') + b' ' + payload for _ in range(count))
+        send(port, b'MADD ' + queue_name + b' ' + str(count).encode('utf8') + b' ' + items)
+        queue_depth -= count
+
+
+def load_benchmark(producers, consumers, payload_size, queue_depth, duration, server_args, server_stderr=None):
+    """producers ADD tasks and check them with IN, consumers GET and ACK them, all for duration seconds"""
+    queue_name = b'bench'
+    payload = b'x' * payload_size
+    add_command = b'ADD ' + queue_name + b' ' + str(payload_size).encode('utf8') + b' ' + payload
+    recorder = LatencyRecorder()
+
+    with tempfile.TemporaryDirectory() as backup_dir:
+        port = get_free_port()
+        server = start_server(port, os.path.join(backup_dir, 'backup.json'), *server_args, stderr=server_stderr)
+        try:
+            prefill_queue(port, queue_name, queue_depth, payload)
+            deadline = time.time() + duration
+
+            def producer():
+                while time.time() < deadline:
+                    task_id = recorder.timed_send(port, 'ADD', add_command)
+                    recorder.timed_send(port, 'IN', b'IN ' + queue_name + b' ' + task_id)
+
+            def consumer():
+                while time.time() < deadline:
+                    response = recorder.timed_send(port, 'GET', b'GET ' + queue_name)
+                    if response == b'NONE':
+                        continue
+                    task_id = response.split(b' ', 1)[0]
+                    recorder.timed_send(port, 'ACK', b'ACK ' + queue_name + b' ' + task_id)
+
+            threads = [threading.Thread(target=producer) for _ in range(producers)] + \
+                      [threading.Thread(target=consumer) for _ in range(consumers)]
+            start_time = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed_time = time.time() - start_time
+        finally:
+            server.terminate()
+            server.wait()
+
+    commands_report = recorder.report(elapsed_time)
+    return {
+        'config': {
+            'producers': producers,
+            'consumers': consumers,
+            'payload_size': payload_size,
+            'queue_depth': queue_depth,
+            'duration': duration,
+            'server_args': [str(arg) for arg in server_args],
+        },
+        'commands': commands_report,
+        'total_ops_per_sec': sum(command['ops_per_sec'] for command in commands_report.values()),
+    }
+
+
+def logging_benchmark(producers, consumers, duration, repeat, server_args):
+    """overhead of logging modes against the server without logging, the log itself goes to /dev/null"""
+    logging_modes = [
+        ('off', []),
+        ('INFO', ['--log_level', 'INFO']),
+        ('INFO 1%', ['--log_level', 'INFO', '--log_sample_rate', '0.01']),
+        ('DEBUG', ['--log_level', 'DEBUG']),
+    ]
+    results = {}
+    for mode_name, logging_args in logging_modes:
+        # the best of several runs, a single short run is too noisy to see a few percent
+        results[mode_name] = max(
+            load_benchmark(producers, consumers, 100, 0, duration, list(server_args) + logging_args,
+                           server_stderr=subprocess.DEVNULL)['total_ops_per_sec']
+            for _ in range(repeat)
+        )
+        print('logging {:<8} {:>10.1f} ops/sec {:>+8.1f}%'.format(
+            mode_name, results[mode_name], (results[mode_name] / results['off'] - 1) * 100
+        ))
+    return results
+
+
+def print_load_report(report):
+    print('{:<5} {:>8} {:>12} {:>10} {:>10} {:>10}'.format('', 'count', 'ops/sec', 'p50 ms', 'p99 ms', 'p999 ms'))
+    for command_name, command in report['commands'].items():
+        print('{:<5} {:>8} {:>12.1f} {:>10} {:>10} {:>10}'.format(
+            command_name, command['count'], command['ops_per_sec'],
+            str(command['p50_ms']), str(command['p99_ms']), str(command['p999_ms'])
+        ))
+    print('total {:>21.1f} ops/sec'.format(report['total_ops_per_sec']))
+
+
+def print_comparison(report, baseline_report):
+    """relative change of throughput and p99 latency against a saved report"""
+    print('{:<5} {:>14} {:>14}'.format('', 'ops/sec', 'p99'))
+    for command_name, command in report['commands'].items():
+        baseline_command = baseline_report['commands'].get(command_name)
+        if not baseline_command or not baseline_command['ops_per_sec'] or not baseline_command['p99_ms']:
+            continue
+        print('{:<5} {:>+13.1f}% {:>+13.1f}%'.format(
+            command_name,
+            (command['ops_per_sec'] / baseline_command['ops_per_sec'] - 1) * 100,
+            ((command['p99_ms'] or 0) / baseline_command['p99_ms'] - 1) * 100
+        ))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    group_commit_parser = subparsers.add_parser('group_commit', help='ADD throughput against group commit window')
+    group_commit_parser.add_argument('--windows', type=float, nargs='+', default=[0, 0.001, 0.005, 0.01, 0.05],
+                                     help='group commit windows to measure, seconds')
+    group_commit_parser.add_argument('--clients', type=int, default=16,
+                                     help='number of concurrent clients')
+    group_commit_parser.add_argument('--requests', type=int, default=200,
+                                     help='requests sent by every client')
+    group_commit_parser.add_argument('--group_commit_size', type=int, default=100,
+                                     help='max number of commands sharing one disk flush')
+
+    logging_parser = subparsers.add_parser('logging', help='throughput with different logging modes')
+    logging_parser.add_argument('--producers', type=int, default=4,
+                                help='number of clients sending ADD and IN')
+    logging_parser.add_argument('--consumers', type=int, default=4,
+                                help='number of clients sending GET and ACK')
+    logging_parser.add_argument('--duration', type=float, default=5,
+                                help='seconds of load for every mode')
+    logging_parser.add_argument('--repeat', type=int, default=3,
+                                help='runs of every mode, the best one is reported')
+    logging_parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                                help='arguments passed to server.py, e.g. -- --async')
+
+    load_parser = subparsers.add_parser('load', help='mixed load of producers and consumers')
+    load_parser.add_argument('--producers', type=int, default=4,
+                             help='number of clients sending ADD and IN')
+    load_parser.add_argument('--consumers', type=int, default=4,
+                             help='number of clients sending GET and ACK')
+    load_parser.add_argument('--payload_size', type=int, default=100,
+                             help='size of task payloads, bytes')
+    load_parser.add_argument('--queue_depth', type=int, default=0,
+                             help='number of tasks added to the queue before measuring')
+    load_parser.add_argument('--duration', type=float, default=5,
+                             help='seconds of load')
+    load_parser.add_argument('--output', type=str,
+                             help='path to save the results as json')
+    load_parser.add_argument('--baseline', type=str,
+                             help='path to results of a previous run to compare with')
+    load_parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                             help='arguments passed to server.py, e.g. -- --async')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.benchmark == 'group_commit':
+        group_commit_benchmark(args.windows, args.clients, args.requests, args.group_commit_size)
+    elif args.benchmark == 'logging':
+        logging_benchmark(args.producers, args.consumers, args.duration, args.repeat,
+                          [arg for arg in args.server_args if arg != '--'])
+    else:
+        server_args = [arg for arg in args.server_args if arg != '--']
+        load_report = load_benchmark(args.producers, args.consumers, args.payload_size, args.queue_depth,
+                                     args.duration, server_args)
+        print_load_report(load_report)
+        if args.baseline:
+            with open(args.baseline, 'r', encoding='utf8') as baseline_file:
+                print_comparison(load_report, json.load(baseline_file))
+        if args.output:
+            with open(args.output, 'w', encoding='utf8') as output_file:
+                json.dump(load_report, output_file, indent='\t')
@@ -0,0 +1,150 @@
+import os
+import json
+import zlib
+import struct
+
+# crc32 of metadata and payload, metadata size, payload size
+RECORD_HEADER = struct.Struct('>III')
+# the last bytes of an indexed snapshot: magic and offset of the index record
+SNAPSHOT_TRAILER = struct.Struct('>8sQ')
+SNAPSHOT_MAGIC = b'TQINDEX1'
+
+
+def write_record(output_file, record):
+    """writes record metadata as json followed by the raw bytes of record['data']"""
+    payload = record.get('data', b'')
+    metadata = json.dumps({key: value for key, value in record.items() if key != 'data'}).encode('utf8')
+    checksum = zlib.crc32(payload, zlib.crc32(metadata))
+
+    output_file.write(RECORD_HEADER.pack(checksum, len(metadata), len(payload)))
+    output_file.write(metadata)
+    output_file.write(payload)
+
+
+def read_records(input_file):
+    """yields (record, offset after the record), stops at the first incomplete or damaged record"""
+    offset = input_file.tell()
+    while True:
+        header = input_file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        checksum, metadata_size, payload_size = RECORD_HEADER.unpack(header)
+
+        metadata = input_file.read(metadata_size)
+        payload = input_file.read(payload_size)
+        if len(metadata) < metadata_size or len(payload) < payload_size:
+            return
+        if zlib.crc32(payload, zlib.crc32(metadata)) != checksum:
+            return
+
+        record = json.loads(metadata.decode('utf8'))
+        # an empty payload is data as well, tasks of zero length have it
+        record['data'] = payload
+        offset += RECORD_HEADER.size + metadata_size + payload_size
+        yield record, offset
+
+
+def fsync_directory(path):
+    """makes a created, renamed or removed entry of the file at path durable"""
+    directory_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def write_snapshot_index(output_file, index):
+    """appends the index record and the trailer pointing to it, must be the last write of a snapshot"""
+    index_offset = output_file.tell()
+    write_record(output_file, index)
+    output_file.write(SNAPSHOT_TRAILER.pack(SNAPSHOT_MAGIC, index_offset))
+
+
+def read_snapshot_index_offset(input_file):
+    """offset of the index record of an indexed snapshot, the header and task records are before it,
+    None for snapshots without an index"""
+    snapshot_size = input_file.seek(0, os.SEEK_END)
+    index_offset = None
+    if snapshot_size >= SNAPSHOT_TRAILER.size:
+        input_file.seek(snapshot_size - SNAPSHOT_TRAILER.size)
+        magic, offset = SNAPSHOT_TRAILER.unpack(input_file.read(SNAPSHOT_TRAILER.size))
+        if magic == SNAPSHOT_MAGIC:
+            index_offset = offset
+
+    input_file.seek(0)
+    return index_offset
+
+
+def read_snapshot_index(input_file):
+    """index record of an indexed snapshot, None for snapshots without an index"""
+    index_offset = read_snapshot_index_offset(input_file)
+    index = None
+    if index_offset is not None:
+        input_file.seek(index_offset)
+        index, _ = next(read_records(input_file), (None, None))
+        input_file.seek(0)
+    return index
+
+
+class Journal:
+    """append-only log of queue mutations in length-prefixed binary records"""
+
+    def __init__(self, path, use_fsync=True):
+        self.path = path
+        self.use_fsync = use_fsync
+        self.last_seq = 0
+        self.records_count = 0
+        self._dirty = False
+        is_created = not os.path.exists(self.path)
+        self._file = open(self.path, 'ab')
+        if is_created and self.use_fsync:
+            # records flushed later are lost with the file if its directory entry is not on the disk
+            fsync_directory(self.path)
+
+    def replay(self, after_seq=0):
+        """yields records written after the given sequence number"""
+        valid_size = 0
+        with open(self.path, 'rb') as journal_file:
+            # a torn tail after a crash was never flushed, so nobody got an answer for it
+            for record, valid_size in read_records(journal_file):
+                self.records_count += 1
+                self.last_seq = max(self.last_seq, record['seq'])
+                if record['seq'] > after_seq:
+                    yield record
+
+        if valid_size != os.path.getsize(self.path):
+            os.truncate(self.path, valid_size)
+
+    def append(self, record, seq=None):
+        """records replicated from a primary keep their sequence numbers"""
+        self.last_seq = self.last_seq + 1 if seq is None else seq
+        record['seq'] = self.last_seq
+        write_record(self._file, record)
+        self.records_count += 1
+        self._dirty = True
+        return self.last_seq
+
+    def flush(self):
+        if not self._dirty:
+            return
+
+        self._file.flush()
+        if self.use_fsync:
+            os.fsync(self._file.fileno())
+        self._dirty = False
+
+    def reset(self):
+        """drops all records, they must be already saved in a snapshot"""
+        self._file.close()
+        self._file = open(self.path, 'wb')
+        self.records_count = 0
+        self._dirty = False
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def remove(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
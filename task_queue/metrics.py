@@ -0,0 +1,82 @@
+import bisect
+
+# seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def format_label(name, value):
+    """name="value" with backslash, double quote and line feed escaped as the text format requires"""
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{}="{}"'.format(name, value)
+
+
+class Histogram:
+    """counts of observations per bucket, observe() is one bisect and two additions"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        lines = []
+        cumulative_count = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative_count += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels + ',' if labels else '', bound,
+                                                           cumulative_count))
+        lines.append('{}_sum{} {}'.format(name, '{' + labels + '}' if labels else '', self.sum))
+        lines.append('{}_count{} {}'.format(name, '{' + labels + '}' if labels else '', self.count))
+        return lines
+
+
+class Metrics:
+    """counters and histograms of the server, rendered in the prometheus text format"""
+
+    def __init__(self):
+        self.command_latency = {}
+        self.persistence_latency = Histogram()
+        self.timeout_redeliveries = 0
+        # ADD and MADD commands answered with FULL
+        self.rejected_commands = 0
+        # seconds spent on loading the snapshot and replaying the journal at startup
+        self.recovery_seconds = 0
+
+    def observe_command(self, command, latency):
+        histogram = self.command_latency.get(command)
+        if histogram is None:
+            histogram = self.command_latency[command] = Histogram()
+        histogram.observe(latency)
+
+    def render(self, gauges):
+        """gauges: (name, labels, value) tuples computed at the moment of rendering"""
+        lines = ['# TYPE task_queue_command_seconds histogram']
+        for command, histogram in sorted(self.command_latency.items()):
+            lines.extend(histogram.render('task_queue_command_seconds', format_label('command', command)))
+
+        lines.append('# TYPE task_queue_persistence_seconds histogram')
+        lines.extend(self.persistence_latency.render('task_queue_persistence_seconds'))
+
+        lines.append('# TYPE task_queue_timeout_redeliveries_total counter')
+        lines.append('task_queue_timeout_redeliveries_total {}'.format(self.timeout_redeliveries))
+
+        lines.append('# TYPE task_queue_rejected_commands_total counter')
+        lines.append('task_queue_rejected_commands_total {}'.format(self.rejected_commands))
+
+        lines.append('# TYPE task_queue_recovery_seconds gauge')
+        lines.append('task_queue_recovery_seconds {}'.format(self.recovery_seconds))
+
+        previous_name = None
+        for name, labels, value in gauges:
+            if name != previous_name:
+                lines.append('# TYPE {} gauge'.format(name))
+                previous_name = name
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+
+        return ('\n'.join(lines) + '\n').encode('utf8')
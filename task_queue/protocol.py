@@ -0,0 +1,284 @@
+WHITESPACE = b' \t\r\n'
+MAX_LINE_SIZE = 1024 * 1024
+# ADD and MADD headers: command, queue and a number must fit into this size
+MAX_HEADER_SIZE = 4096
+MAX_FRAME_HEADER_SIZE = 16
+
+# min and max number of arguments of commands which are one line of tokens
+LINE_ARGUMENTS_COUNT = {b'get': (1, 2), b'ack': (2, 2), b'in': (2, 2), b'mget': (2, 2), b'mack': (2, None),
+                        b'stats': (0, 0), b'pipeline': (0, 0)}
+DATA_COMMANDS = (b'add', b'madd')
+MAX_COMMAND_NAME_SIZE = max(len(name) for name in list(LINE_ARGUMENTS_COUNT) + list(DATA_COMMANDS))
+
+
+def parse_command(data, at_end=False, is_drained=False):
+    """(arguments, command size) of the first complete command in data, None if more bytes are needed
+
+    Arguments are the lowercased command name followed by bytes tokens, ADD and MADD data are
+    (length, memoryview) pairs referencing data without copying. A command of one line ends with
+    a line feed, without it the command is complete at_end, when the stream is closed,
+    or once all of its arguments are received and no more bytes are waiting (is_drained).
+    """
+    arguments, command_end = read_command(data, 0, at_end, is_drained)
+    return None if arguments is None else (arguments, command_end)
+
+
+def read_command(data, start=0, at_end=False, is_drained=False):
+    """(arguments, command end) of the first complete command in data after start,
+    (None, size data must reach before the command may be complete) if more bytes are needed"""
+    while start < len(data) and data[start] in WHITESPACE:
+        start += 1
+    if start == len(data):
+        return None, len(data) + 1
+
+    command = bytes(data[start:start + MAX_COMMAND_NAME_SIZE + 1].split(None, 1)[0]).lower()
+    if command in DATA_COMMANDS:
+        return _parse_data_command(data, start, command)
+    if command in LINE_ARGUMENTS_COUNT:
+        return _parse_line_command(data, start, command, at_end, is_drained)
+
+    # the name itself may be incomplete
+    if start + len(command) == len(data) and not at_end and \
+            any(name.startswith(command) for name in list(LINE_ARGUMENTS_COUNT) + list(DATA_COMMANDS)):
+        return None, len(data) + 1
+    raise ValueError('Wrong command.')
+
+
+def _parse_line_command(data, start, command, at_end, is_drained):
+    line_end = data.find(b'\n', start, start + MAX_LINE_SIZE)
+    if line_end == -1:
+        if len(data) - start >= MAX_LINE_SIZE:
+            raise ValueError('Too long command')
+        if not at_end and not is_drained:
+            # "GET my" may be followed by "queue"
+            return None, len(data) + 1
+        tokens, command_end = data[start:].split(), len(data)
+    else:
+        tokens, command_end = data[start:line_end].split(), line_end + 1
+
+    min_count, max_count = LINE_ARGUMENTS_COUNT[command]
+    if command == b'mack' and len(tokens) >= 3:
+        # MACK <queue> <count> <id> ... <id>
+        if not tokens[2].isdigit():
+            raise ValueError('Wrong request structure')
+        min_count = max_count = 2 + int(tokens[2])
+
+    if line_end == -1 and not at_end and len(tokens) - 1 < min_count:
+        # the rest of the arguments is not received yet
+        return None, len(data) + 1
+    if len(tokens) - 1 < min_count or max_count is not None and len(tokens) - 1 > max_count:
+        raise ValueError('Wrong request structure')
+
+    return [command.decode('ascii')] + [bytes(token) for token in tokens[1:]], command_end
+
+
+def _skip_token(data, position, token):
+    """position after the token, the token is known to be the next one after whitespace"""
+    return data.find(token, position) + len(token)
+
+
+def _peek_token(data, position, peek_size=64):
+    """(token after whitespace, position after it), None token if it may be incomplete yet"""
+    token_header = data[position:position + peek_size].split(None, 1)
+    if not token_header:
+        return None, position
+    token = bytes(token_header[0])
+    token_end = _skip_token(data, position, token)
+    if token_end >= position + peek_size:
+        raise ValueError('Wrong request structure')
+    if token_end == len(data):
+        return None, position
+    return token, token_end
+
+
+def _read_payload(data, position):
+    """<length> <data> after whitespace: ((length, data view), position after it),
+    (None, size data must reach) if more bytes are needed"""
+    length, length_end = _peek_token(data, position)
+    if length is None:
+        return None, len(data) + 1
+    if not length.isdigit():
+        raise ValueError('Wrong request structure')
+
+    # exactly one separator after the length, the payload itself may start with whitespace
+    payload_start = length_end + 1
+    payload_end = payload_start + int(length)
+    if payload_end > len(data):
+        return None, payload_end
+    return (length, memoryview(data)[payload_start:payload_end]), payload_end
+
+
+def _parse_data_command(data, start, command):
+    """ADD <queue> [<option>=<value> ...] <length> <data>
+    and MADD <queue> [<option>=<value> ...] <count> <length> <data> ... <length> <data>"""
+    # a short look ahead is enough for usual queue names, the slice is copied
+    header = data[start:start + 256].split(None, 2)
+    if len(header) < 3 and len(data) - start > 256:
+        header = data[start:start + MAX_HEADER_SIZE].split(None, 2)
+    if len(header) < 3:
+        if len(data) - start >= MAX_HEADER_SIZE:
+            raise ValueError('Wrong request structure')
+        return None, len(data) + 1
+
+    queue_name = bytes(header[1])
+    position = _skip_token(data, start + len(command), queue_name)
+    arguments = [command.decode('ascii'), queue_name]
+    while True:
+        token, token_end = _peek_token(data, position)
+        if token is None:
+            return None, len(data) + 1
+        if b'=' not in token:
+            break
+        arguments.append(token)
+        position = token_end
+
+    if command == b'add':
+        payload, position = _read_payload(data, position)
+        if payload is None:
+            return None, position
+        arguments.append(payload)
+    else:
+        count, position = token, token_end
+        if not count.isdigit():
+            raise ValueError('Wrong request structure')
+
+        arguments.append(count)
+        for _ in range(int(count)):
+            payload, position = _read_payload(data, position)
+            if payload is None:
+                return None, position
+            arguments.append(payload)
+
+    command_end = position
+    while command_end < len(data) and data[command_end] in b' \t\r':
+        command_end += 1
+    if command_end < len(data) and data[command_end] != ord(b'\n'):
+        raise ValueError('Wrong request structure')
+    return arguments, min(command_end + 1, len(data))
+
+
+def parse_complete_command(data):
+    """arguments of a command which must take the whole data"""
+    parsed_command = parse_command(data, at_end=True)
+    if parsed_command is None or data[parsed_command[1]:].strip():
+        raise ValueError('Wrong request')
+    return parsed_command[0]
+
+
+def error_response(error):
+    """answer to a command which can not be parsed or processed, the server goes on serving others"""
+    return 'ERROR {}'.format(error).encode('utf8')
+
+
+def decode_token(token):
+    """queue names and task ids are case-insensitive"""
+    return token.decode('utf8').lower()
+
+
+def get_wait_timeout(arguments):
+    """timeout of a blocking GET <queue> <timeout> in seconds, None for other commands"""
+    if arguments[0] != 'get' or len(arguments) != 3:
+        return None
+    return float(arguments[2])
+
+
+class CommandReader:
+    """received bytes of a connection, cuts complete commands out of them
+
+    Chunks are joined only when they may hold a complete command, a large payload is joined
+    and parsed once and not after every chunk.
+    """
+
+    def __init__(self, data=b''):
+        self._data = bytes(data)
+        self._position = 0
+        self._chunks = []
+        self._size = len(self._data)
+        # the buffered bytes are not parsed again until there are this many of them
+        self._needed_size = 1
+        self._pending_name = None
+
+    def feed(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+
+    def next_command(self, at_end=False, is_drained=False):
+        """(command view, arguments) of the next complete command, None if more bytes are needed
+
+        At the end of the stream a line command without a terminator is complete and an incomplete
+        command raises ValueError, None means that nothing but whitespace is left. When no more
+        bytes are waiting (is_drained) a line command without a terminator is complete
+        once all of its arguments are received, as the clients of the original protocol expect.
+        """
+        if self._size < self._needed_size and not at_end:
+            return None
+        if self._chunks:
+            self._data = b''.join([memoryview(self._data)[self._position:]] + self._chunks)
+            self._position = 0
+            self._chunks = []
+
+        arguments, command_end = read_command(self._data, self._position, at_end, is_drained)
+        if arguments is None:
+            if at_end and self._data[self._position:].strip():
+                raise ValueError('Incomplete command')
+            self._needed_size = command_end - self._position
+            name = self._data[self._position:self._position + MAX_COMMAND_NAME_SIZE + 1].split(None, 1)
+            self._pending_name = name[0].lower() if name else None
+            return None
+
+        # payload views reference the joined bytes, which are never changed
+        command = memoryview(self._data)[self._position:command_end]
+        self._size -= command_end - self._position
+        self._position = command_end
+        self._needed_size = 1
+        self._pending_name = None
+        return command, arguments
+
+    def rest(self):
+        return b''.join([self._data[self._position:]] + self._chunks)
+
+    def pending_command_name(self):
+        """lowercased name of the command which is received partially, None if nothing is buffered"""
+        return self._pending_name
+
+
+def parse_frame(data, start=0):
+    """returns (command, frame end) for the first complete frame in data after start, None if more bytes are needed"""
+    header_end = data.find(b'\n', start, start + MAX_FRAME_HEADER_SIZE)
+    if header_end == -1:
+        if len(data) - start >= MAX_FRAME_HEADER_SIZE:
+            raise ValueError('Wrong frame header')
+        return None
+    if not data[start:header_end].isdigit():
+        raise ValueError('Wrong frame header')
+
+    frame_end = header_end + 1 + int(data[start:header_end])
+    if len(data) < frame_end:
+        return None
+    # the command is copied once, the buffer may be a bytearray which is changed later
+    with memoryview(data) as data_view:
+        return bytes(data_view[header_end + 1:frame_end]), frame_end
+
+
+def response_chunks(response):
+    """responses are bytes or a tuple of buffers which are sent one after another without joining"""
+    if isinstance(response, tuple):
+        return response
+    return (response,)
+
+
+def send_chunks(connection, chunks):
+    """gathering write of all chunks, the payload is not copied into one response buffer"""
+    chunks = [memoryview(chunk) for chunk in chunks]
+    while chunks:
+        sent_size = connection.sendmsg(chunks)
+        while chunks and sent_size >= len(chunks[0]):
+            sent_size -= len(chunks[0])
+            chunks.pop(0)
+        if chunks:
+            chunks[0] = chunks[0][sent_size:]
+
+
+def pack_frame(response):
+    chunks = response_chunks(response)
+    return (str(sum(len(chunk) for chunk in chunks)).encode('utf8') + b'\n',) + chunks
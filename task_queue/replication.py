@@ -0,0 +1,143 @@
+import io
+import os
+import time
+import socket
+import collections
+
+from journal import write_record, read_records, read_snapshot_index_offset
+
+
+def pack_records(records):
+    """records in the journal format, the same bytes are sent to every standby"""
+    output_file = io.BytesIO()
+    for record in records:
+        write_record(output_file, record)
+    return output_file.getvalue()
+
+
+class ReplicaBuffer:
+    """bytes for one standby: records of a snapshot file followed by flushed mutations
+
+    The snapshot is read from the file when the standby can take more, mutations wait in memory.
+    on_data(buffer) is called after every append, it may send what the standby takes at once.
+    When more than max_buffer_size bytes of mutations are waiting the standby is too slow,
+    the buffer is closed and the standby has to connect again.
+    """
+
+    def __init__(self, snapshot_path, max_buffer_size, on_data=None, on_close=None, chunk_size=65536):
+        self._snapshot_file = open(snapshot_path, 'rb')
+        # the index and the trailer are not sent, the standby reads the header and task records only
+        self._snapshot_left = read_snapshot_index_offset(self._snapshot_file)
+        if self._snapshot_left is None:
+            self._snapshot_left = os.path.getsize(snapshot_path)
+        self._chunks = collections.deque()
+        self._unsent = None
+        self.buffer_size = 0
+        self.max_buffer_size = max_buffer_size
+        self.chunk_size = chunk_size
+        self.is_closed = False
+        self.is_overflown = False
+        self._on_data = on_data
+        self._on_close = on_close
+
+    def append(self, data):
+        if self.is_closed:
+            return
+        self._chunks.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size > self.max_buffer_size:
+            self.is_overflown = True
+            self.close()
+        elif self._on_data is not None:
+            self._on_data(self)
+
+    def has_data(self):
+        return bool(self._snapshot_left or self._chunks or self._unsent)
+
+    def pop_chunk(self):
+        """the next bytes to send, None if there are no such bytes now"""
+        if self._snapshot_left:
+            chunk = self._snapshot_file.read(min(self.chunk_size, self._snapshot_left))
+            self._snapshot_left = self._snapshot_left - len(chunk) if chunk else 0
+            if not self._snapshot_left:
+                self._snapshot_file.close()
+            return chunk
+        if self._chunks:
+            chunk = self._chunks.popleft()
+            self.buffer_size -= len(chunk)
+            return chunk
+        return None
+
+    def send_to(self, connection):
+        """sends what the non-blocking socket takes now, OSError means that the standby is gone"""
+        while True:
+            if not self._unsent:
+                chunk = self.pop_chunk()
+                if chunk is None:
+                    return
+                self._unsent = memoryview(chunk)
+            try:
+                sent_size = connection.send(self._unsent)
+            except BlockingIOError:
+                return
+            self._unsent = self._unsent[sent_size:]
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self._snapshot_file.close()
+        self._chunks.clear()
+        self._unsent = None
+        self.buffer_size = 0
+        if self._on_close is not None:
+            self._on_close()
+
+
+class ReplicationStream:
+    """connection of a standby to the primary: its state records followed by every flushed mutation
+
+    The stream is read like a journal file by read_records.
+    """
+
+    def __init__(self, port, connect_timeout=5):
+        deadline = time.time() + connect_timeout
+        while True:
+            try:
+                self._connection = socket.create_connection(('127.0.0.1', port))
+                break
+            except OSError:
+                # the primary may still be starting
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            try:
+                data = self._connection.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            self._buffer += data
+
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._offset += len(chunk)
+        return chunk
+
+    def tell(self):
+        return self._offset
+
+    def is_drained(self):
+        """all received bytes are read, a good moment to flush what is applied"""
+        return not self._buffer
+
+    def records(self):
+        return read_records(self)
+
+    def close(self):
+        self._connection.close()
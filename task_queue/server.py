@@ -1,187 +1,1016 @@
-import re
 import os
 import json
+import math
 import time
 import socket
-import random
-import string
+import select
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import queue
+import itertools
+import collections
 import argparse
+import functools
+
+from journal import (Journal, fsync_directory, write_record, read_records, write_snapshot_index,
+                     read_snapshot_index)
+from storage import TaskQueue, QueueDict, ExpiryScheduler, PayloadStore
+from protocol import (parse_complete_command, error_response, decode_token, get_wait_timeout,
+                      CommandReader, parse_frame, pack_frame, response_chunks, send_chunks)
+from sharding import get_shard_index, get_queue_shard_index, check_backup_layout, ShardClient, run_sharded
+from metrics import Metrics, format_label
+from replication import pack_records, ReplicaBuffer, ReplicationStream
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """the queue is read in the same process, so records are passed as is and formatted by the listener"""
+
+    def emit(self, record):
+        self.enqueue(record)
+
+
+def configure_logging(logger, log_level):
+    """records are formatted and written by a background thread, the server only puts them into a queue"""
+    logger.setLevel(log_level)
+    if logger.handlers:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('{asctime} {levelname} {funcName:.>35} {message}', style='{'))
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(LocalQueueHandler(log_queue))
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
 
 
 class Server:
-    def __init__(self, port=5555, backup_file_path='backup.json', task_timeout=5*60):
+    def __init__(self, port=5555, backup_file_path='backup.json', task_timeout=5*60, compaction_threshold=10000,
+                 group_commit_window=0, group_commit_size=100, receive_timeout=1,
+                 timeouts_check_interval=1, payload_memory_limit=None, payload_dir=None, shard_index=0, shards_count=1,
+                 max_batch_size=1000, log_level=None, log_sample_rate=1.0, metrics_port=None, replication_port=None,
+                 replicate_from=None, replica_buffer_size=64 * 1024 * 1024, max_queue_tasks=None, max_queue_bytes=None,
+                 max_tasks=None, max_bytes=None):
         self._func_dict = {
             'add': self.add_task,
             'get': self.get_task,
             'ack': self.ack_status,
-            'in': self.in_queue
+            'in': self.in_queue,
+            'madd': self.add_tasks,
+            'mget': self.get_tasks,
+            'mack': self.ack_statuses,
+            'stats': self.get_stats
         }
 
-        self.queue_dict = {}
-        self.timeouts_list = []
+        self.timeouts = ExpiryScheduler()
         self.port = port
         self.backup_file_path = backup_file_path
-        self.load_backup()
+        self.journal_file_path = backup_file_path + '.journal'
+        self.compaction_threshold = compaction_threshold
         self.task_timeout = task_timeout
+        # group commit is off with zero window: every command is flushed before the next one is accepted
+        self.group_commit_window = group_commit_window
+        self.group_commit_size = group_commit_size
+        self.receive_timeout = receive_timeout
+        self.timeouts_check_interval = timeouts_check_interval
+        # every shard process owns a part of queues, commands for other queues are sent to their owners
+        self.shard_index = shard_index
+        self.shards_count = shards_count
+        self.max_batch_size = max_batch_size
+        self.logger = logging.getLogger('task_queue')
+        if log_level:
+            configure_logging(self.logger, log_level)
+        if not 0 < log_sample_rate <= 1:
+            raise ValueError('log_sample_rate {} is not in (0, 1]'.format(log_sample_rate))
+        # per request records are written for log_sample_rate of requests:
+        # whenever the number of requests times the rate passes an integer
+        self._log_requests = self.logger.isEnabledFor(logging.INFO)
+        self._log_sample_rate = log_sample_rate
+        self._requests_count = 0
+
+        self.metrics = Metrics()
+        # prometheus text over http, every shard uses its own port
+        self.metrics_port = metrics_port + shard_index if metrics_port else None
+
+        # a primary sends its state and then every flushed mutation to standbys connected to this port
+        self.replication_port = replication_port + shard_index if replication_port else None
+        # a standby follows the primary with this replication port and takes over when it is lost
+        self.replicate_from = replicate_from + shard_index if replicate_from else None
+        # buffers of connected standbys and mutations which are not flushed yet
+        self._replicas = []
+        self._replication_records = []
+        # a standby with more bytes of mutations waiting for it is disconnected, the primary never waits for it
+        self.replica_buffer_size = replica_buffer_size
+
+        # ADD and MADD are answered with FULL when a task does not fit into these limits
+        self.max_queue_tasks = max_queue_tasks
+        self.max_queue_bytes = max_queue_bytes
+        self.max_tasks = max_tasks
+        self.max_bytes = max_bytes
+        self._stored_tasks = 0
+        self._stored_bytes = 0
+        # bytes of commands which are being received, they are counted in max_bytes as well
+        self._receiving_bytes = 0
+
+        # futures of blocking GET requests per queue, woken when a task becomes available
+        self._task_waiters = {}
+        # without the limit all payloads are kept in memory and no segment files are created
+        if payload_memory_limit is not None:
+            self.payload_store = PayloadStore(payload_dir or backup_file_path + '.segments', payload_memory_limit)
+        else:
+            self.payload_store = PayloadStore()
+        self.queue_dict = QueueDict(self.payload_store)
+        if self.replicate_from:
+            # the local state is replaced by the state of the primary anyway
+            self.journal = Journal(self.journal_file_path)
+        else:
+            self.load_backup()
 
     def load_backup(self):
-        if not os.path.exists(self.backup_file_path):
-            return
+        """loads the last snapshot and replays the journal written after it"""
+        start_time = time.perf_counter()
+        snapshot_seq = 0
+        if os.path.exists(self.backup_file_path):
+            with open(self.backup_file_path, 'rb') as backup_file:
+                if backup_file.peek(1)[:1] == b'{':
+                    snapshot_seq = self._load_json_backup(backup_file)
+                else:
+                    snapshot_index = read_snapshot_index(backup_file)
+                    snapshot_seq = self._load_snapshot(read_records(backup_file), snapshot_index)
+
+        self.journal = Journal(self.journal_file_path)
+        for record in self.journal.replay(after_seq=snapshot_seq):
+            if record['op'] == 'add' and self.shards_count > 1 and \
+                    get_queue_shard_index(record['queue'], self.shards_count) != self.shard_index:
+                raise ValueError('{} is written with another number of workers'.format(self.journal_file_path))
+            self._apply_record(record)
+        self.journal.last_seq = max(self.journal.last_seq, snapshot_seq)
+        self.metrics.recovery_seconds = time.perf_counter() - start_time
+        self.logger.info('backup loaded in %.3f s: %d queues, %d tasks given to workers',
+                         self.metrics.recovery_seconds, len(self.queue_dict), len(self.timeouts))
+
+    def _load_snapshot(self, records, snapshot_index=None):
+        """records of a snapshot file or a replication stream, where more records follow the tasks
+
+        Queues of an indexed snapshot file are not read here, they are loaded on the first access.
+        """
+        snapshot_header, _ = next(records)
+        if snapshot_header.get("shards_count", self.shards_count) != self.shards_count:
+            # queues are partitioned by the number of shards, some of them would be served by wrong shards
+            raise ValueError('the snapshot is written by {} workers'.format(snapshot_header["shards_count"]))
+
+        self.queue_dict = QueueDict(self.payload_store)
+        if snapshot_index is not None:
+            self.queue_dict.attach_snapshot(self.backup_file_path, snapshot_index["queues"])
+        else:
+            # every payload goes to the payload store as its record is read
+            for task, _ in itertools.islice(records, snapshot_header.get("tasks_count")):
+                queue_name = task.pop('queue')
+                task_queue = self.queue_dict.get(queue_name)
+                if task_queue is None:
+                    task_queue = self.queue_dict[queue_name] = TaskQueue(self.payload_store)
+                task_queue.restore(task)
+        self._count_stored_tasks()
 
-        with open(self.backup_file_path, 'r', encoding='utf8') as backup_file:
-            backup_data = json.load(backup_file)
-        self.queue_dict = backup_data["queue_dict"]
-        self.timeouts_list = backup_data["timeouts_list"]
+        self.timeouts = ExpiryScheduler.from_list(snapshot_header["timeouts_list"])
+        return snapshot_header["last_seq"]
+
+    def _load_json_backup(self, backup_file):
+        """backup of the old format: json with payloads as lists of ints"""
+        backup_data = json.loads(backup_file.read().decode('utf8'))
+        for tasks in backup_data["queue_dict"].values():
+            for task in tasks:
+                task['data'] = bytes(task['data'])
+
+        self.queue_dict = QueueDict(self.payload_store)
+        for queue_name, tasks in backup_data["queue_dict"].items():
+            self.queue_dict[queue_name] = TaskQueue.from_list(tasks, self.payload_store)
+        self._count_stored_tasks()
+        self.timeouts = ExpiryScheduler.from_list(backup_data["timeouts_list"])
+        return backup_data.get("last_seq", 0)
+
+    def _count_stored_tasks(self):
+        self._stored_tasks = self._stored_bytes = 0
+        for _, tasks_count, _, payload_bytes in self.queue_dict.sizes():
+            self._stored_tasks += tasks_count
+            self._stored_bytes += payload_bytes
 
     def write_file(self):
-        backup_data = json.dumps({"queue_dict": self.queue_dict, "timeouts_list": self.timeouts_list}, indent='\t')
-        with open(self.backup_file_path, 'w', encoding='utf8') as backup_file:
-            backup_file.write(backup_data)
+        """makes all mutations since the previous call durable, must be called before answering the client"""
+        start_time = time.perf_counter()
+        self.journal.flush()
+        if self._replication_records:
+            self._send_to_replicas(pack_records(self._replication_records))
+            self._replication_records = []
+        if self.journal.records_count >= self.compaction_threshold:
+            self.write_snapshot()
+        self.metrics.persistence_latency.observe(time.perf_counter() - start_time)
+
+    def write_snapshot(self):
+        """a header record with timeouts, task records grouped by queues and the index of queues
+
+        Queues which are not loaded since the previous snapshot are copied from it without parsing.
+        """
+        tmp_file_path = self.backup_file_path + '.tmp'
+        snapshot_index = {}
+        with open(tmp_file_path, 'wb') as backup_file:
+            write_record(backup_file, self._state_header())
+            for queue_name in self.queue_dict.names():
+                queue_offset = backup_file.tell()
+                tasks_count, in_flight_count, payload_bytes = self.queue_dict.write_queue(backup_file, queue_name)
+                snapshot_index[queue_name] = [queue_offset, backup_file.tell() - queue_offset, tasks_count,
+                                              in_flight_count, payload_bytes]
+            write_snapshot_index(backup_file, {"queues": snapshot_index})
+            backup_file.flush()
+            os.fsync(backup_file.fileno())
+        os.replace(tmp_file_path, self.backup_file_path)
+        # the truncated journal must not reach the disk before the new snapshot does
+        fsync_directory(self.backup_file_path)
+        self.queue_dict.attach_snapshot(self.backup_file_path, snapshot_index)
+        self.logger.info('snapshot written up to journal record %d', self.journal.last_seq)
+        # records up to last_seq are skipped on replay now, so a crash before the reset is harmless
+        self.journal.reset()
+
+    def _state_header(self):
+        return {
+            "timeouts_list": self.timeouts.to_list(),
+            "last_seq": self.journal.last_seq,
+            "tasks_count": self._stored_tasks,
+            "shards_count": self.shards_count
+        }
+
+    def _add_replica(self, on_data=None, on_close=None):
+        """buffer of a new standby: a fresh snapshot followed by every flushed mutation
+
+        Queues which are not loaded are copied into the snapshot as they are, the snapshot file
+        is sent as the standby reads it.
+        """
+        # the state must not contain mutations which are not durable on the primary
+        self.write_file()
+        self.write_snapshot()
+        replica = ReplicaBuffer(self.backup_file_path, self.replica_buffer_size, on_data, on_close)
+        self._replicas.append(replica)
+        self.logger.info('standby connected, %d standbys', len(self._replicas))
+        return replica
+
+    def _send_to_replicas(self, data):
+        for replica in list(self._replicas):
+            replica.append(data)
+            if replica.is_overflown:
+                self.logger.warning('standby does not keep up, more than %d bytes are not sent to it',
+                                    self.replica_buffer_size)
+                self._remove_replica(replica)
+
+    def _remove_replica(self, replica):
+        replica.close()
+        if replica in self._replicas:
+            self._replicas.remove(replica)
+            self.logger.warning('standby disconnected, %d standbys', len(self._replicas))
+
+    def follow_primary(self):
+        """hot standby: applies the state and the mutations of the primary until it is lost, then returns
+
+        The primary drops a standby which does not keep up, so the end of the stream does not mean that
+        the primary is lost: the standby connects again and loads a fresh state. Only a primary which
+        does not accept the standby any more is taken over.
+        """
+        stream = ReplicationStream(self.replicate_from)
+        while True:
+            self._follow_stream(stream)
+            stream.close()
+            self.write_file()
+            try:
+                stream = ReplicationStream(self.replicate_from, connect_timeout=0)
+            except OSError:
+                break
+            self.logger.warning('disconnected by the primary at journal record %d, connecting again',
+                                self.journal.last_seq)
+        self.logger.warning('primary is lost at journal record %d, taking over', self.journal.last_seq)
+
+    def _follow_stream(self, stream):
+        records = stream.records()
+        snapshot_header = next(records, None)
+        if snapshot_header is None:
+            # the primary is gone before sending its state, the state loaded before is kept
+            return
+        # payloads of the previous state are dropped with it
+        self.payload_store = PayloadStore(self.payload_store.directory, self.payload_store.memory_limit,
+                                          self.payload_store.segment_size)
+        self.journal.last_seq = self._load_snapshot(itertools.chain([snapshot_header], records))
+        self.write_snapshot()
+        self.logger.info('state of the primary loaded up to journal record %d', self.journal.last_seq)
+
+        for record, _ in records:
+            self._apply_record(record)
+            self.journal.append(record, record['seq'])
+            if stream.is_drained():
+                self.write_file()
 
     def remove_logs(self):
+        self.journal.remove()
+
         if not os.path.exists(self.backup_file_path):
             return
 
         os.remove(self.backup_file_path)
 
-    def check_timeouts(self):
-        for given_task in self.timeouts_list:
-            # breaking the cycle because the most recent task are at the beginning of this queue
-            if time.time() - given_task['timestamp'] < self.task_timeout:
+    def _commit(self, record):
+        """applies the mutation in memory and appends it to the journal"""
+        self._apply_record(record)
+        self.journal.append(record)
+        if self._replicas:
+            self._replication_records.append(record)
+
+    def _apply_record(self, record):
+        operation = record['op']
+        current_queue = record['queue']
+
+        if operation == 'add':
+            if current_queue not in self.queue_dict:
+                self.queue_dict[current_queue] = TaskQueue(self.payload_store)
+            self.queue_dict[current_queue].add(record['id'], record['length'], record['data'],
+                                               record.get('priority', 0), record.get('not_before', 0))
+            self._stored_tasks += 1
+            self._stored_bytes += int(record['length'])
+            self._wake_task_waiter(current_queue)
+            return
+
+        task_queue = self.queue_dict.get(current_queue)
+        if task_queue is None or record['id'] not in task_queue:
+            return
+
+        if operation == 'get':
+            task_queue.take(record['id'])
+            self.timeouts.schedule(current_queue, record['id'], record['timestamp'])
+        elif operation == 'timeout':
+            task_queue.release(record['id'])
+            self.timeouts.cancel(current_queue, record['id'])
+            self._wake_task_waiter(current_queue)
+        elif operation == 'ack':
+            task = task_queue.remove(record['id'])
+            self._stored_tasks -= 1
+            self._stored_bytes -= int(task['length'])
+            self.timeouts.cancel(current_queue, record['id'])
+
+    def _wake_task_waiter(self, current_queue):
+        task_waiters = self._task_waiters.get(current_queue)
+        while task_waiters:
+            task_waiter = task_waiters.popleft()
+            if not task_waiter.done():
+                task_waiter.set_result(None)
                 break
+        if task_waiters is not None and not task_waiters:
+            del self._task_waiters[current_queue]
+
+    def _remove_task_waiter(self, current_queue, task_waiter):
+        """a timed out or cancelled waiter, queues without waiters are not kept"""
+        task_waiters = self._task_waiters.get(current_queue)
+        if task_waiters is None:
+            return
+        try:
+            task_waiters.remove(task_waiter)
+        except ValueError:
+            # the waiter is woken already
+            pass
+        if not task_waiters:
+            del self._task_waiters[current_queue]
 
-            for task in self.queue_dict[given_task['queue']]:
-                if task['id'] == given_task['id']:
-                    task['is_available'] = True
-                    self.timeouts_list.remove(given_task)
+    def check_timeouts(self):
+        """returns timed out tasks to their queues, costs O(1) when nothing is expired"""
+        for queue_name, task_id in self.timeouts.pop_expired(time.time() - self.task_timeout):
+            self.logger.debug('task %s in queue %s timed out', task_id, queue_name)
+            self.metrics.timeout_redeliveries += 1
+            self._commit({'op': 'timeout', 'queue': queue_name, 'id': task_id})
 
     def run(self):
+        if self.replicate_from:
+            self.follow_primary()
+
         connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         connection.bind(('127.0.0.1', self.port))
-        connection.listen(10)
+        connection.listen(128)
+        self.logger.info('listening on port %d', self.port)
+
+        listeners = [connection]
+        if self.metrics_port:
+            metrics_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            metrics_connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            metrics_connection.bind(('127.0.0.1', self.metrics_port))
+            metrics_connection.listen(16)
+            listeners.append(metrics_connection)
+        if self.replication_port:
+            replication_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            replication_connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            replication_connection.bind(('127.0.0.1', self.replication_port))
+            replication_connection.listen(16)
+            listeners.append(replication_connection)
+
+        # connections whose mutations are not on the disk yet, answered all at once after the flush
+        waiting_responses = []
+        # non-blocking sockets of standbys, they are written when they can take more
+        replica_connections = {}
+        batch_started_at = 0
+        next_timeouts_check = time.time()
         while True:
-            current_connection, address = connection.accept()
-            current_connection.setblocking(False)
+            if time.time() >= next_timeouts_check:
+                self.check_timeouts()
+                next_timeouts_check = time.time() + self.timeouts_check_interval
 
-            data_received_from_connection = b''
-            while True:
+            select_timeout = next_timeouts_check - time.time()
+            if waiting_responses:
+                select_timeout = min(select_timeout, batch_started_at + self.group_commit_window - time.time())
+
+            replica_connections = {replica_connection: replica for replica_connection, replica
+                                   in replica_connections.items() if not replica.is_closed}
+            writable_replicas = [replica_connection for replica_connection, replica in replica_connections.items()
+                                 if replica.has_data()]
+            readable, writable, _ = select.select(listeners + list(replica_connections), writable_replicas, [],
+                                                  max(0, select_timeout))
+            for replica_connection in set(readable + writable) & set(replica_connections):
+                replica = replica_connections[replica_connection]
                 try:
-                    data = current_connection.recv(1024)
-                    if data:
-                        data_received_from_connection += data
-                    else:
-                        break
-                except BlockingIOError:
+                    # the standby sends nothing, a readable socket means that it is gone
+                    if replica_connection in readable and not replica_connection.recv(65536):
+                        raise ConnectionError('Standby connection closed')
+                except OSError:
+                    self._remove_replica(replica)
+                    continue
+                if replica_connection in writable:
+                    self._write_replica(replica_connection, replica)
+            if self.metrics_port and metrics_connection in readable:
+                metrics_request, address = metrics_connection.accept()
+                # the request itself does not matter, every path returns the metrics
+                metrics_request.settimeout(self.receive_timeout)
+                try:
+                    metrics_request.recv(65536)
+                except socket.timeout:
+                    pass
+                metrics_request.settimeout(None)
+                send_chunks(metrics_request, self._get_metrics_http_response())
+                metrics_request.close()
+            if self.replication_port and replication_connection in readable:
+                replica_connection, address = replication_connection.accept()
+                replica_connection.setblocking(False)
+                replica_connections[replica_connection] = self._add_replica(
+                    on_data=functools.partial(self._write_replica, replica_connection),
+                    on_close=replica_connection.close)
+            if connection in readable:
+                current_connection, address = connection.accept()
+                try:
+                    parsed_command = self._receive_command(current_connection)
+                    response = self.process_task(*parsed_command) if parsed_command is not None else None
+                except ValueError as error:
+                    # a wrong or incomplete command is answered, the server goes on with other clients
+                    response = error_response(error)
+                if response is None:
+                    # nothing is sent at all
+                    current_connection.close()
+                    continue
+
+                if not waiting_responses:
+                    batch_started_at = time.time()
+                waiting_responses.append((current_connection, response))
+
+            if not waiting_responses:
+                continue
+            if len(waiting_responses) >= self.group_commit_size or \
+                    time.time() - batch_started_at >= self.group_commit_window:
+                self._send_batch(waiting_responses)
+                waiting_responses = []
+
+    def _receive_command(self, current_connection):
+        """(command, arguments) of the connection, None if nothing is sent, ValueError for a wrong command"""
+        command_reader = CommandReader()
+        parsed_command = None
+        try:
+            current_connection.settimeout(self.receive_timeout)
+            while parsed_command is None:
+                try:
+                    data = current_connection.recv(65536)
+                except OSError:
+                    # a timeout or a reset connection, whatever is received is processed
+                    break
+                if not data:
                     break
+                command_reader.feed(data)
+                # a line command without its line feed is complete when no more bytes are waiting
+                is_drained = not select.select([current_connection], [], [], 0)[0]
+                parsed_command = command_reader.next_command(is_drained=is_drained)
+        finally:
+            current_connection.settimeout(None)
 
-            response = self.process_task(data_received_from_connection)
+        if parsed_command is None:
+            parsed_command = command_reader.next_command(at_end=True)
+        return parsed_command
 
-            self.write_file()
+    def _write_replica(self, replica_connection, replica):
+        """sends what the standby socket takes without waiting, the rest is sent when it is writable"""
+        try:
+            replica.send_to(replica_connection)
+        except OSError:
+            self._remove_replica(replica)
 
-            current_connection.send(response)
+    def _send_batch(self, waiting_responses):
+        """one flush for the whole batch, then every client gets its answer"""
+        self.write_file()
 
+        for current_connection, response in waiting_responses:
+            try:
+                send_chunks(current_connection, response_chunks(response))
+            except OSError:
+                # the client is gone, the rest of the batch is answered anyway
+                pass
             current_connection.close()
 
-    def process_task(self, command_bytes):
-        task = command_bytes.strip()
+    def run_async(self):
+        if self.replicate_from:
+            self.follow_primary()
+        asyncio.run(self._serve_async())
 
-        self.check_timeouts()
+    async def _serve_async(self):
+        self._batch_future = None
+        self._batch_timer = None
+        self._batch_size = 0
+        self._shard_clients = {shard_index: ShardClient(self._get_shard_port(shard_index))
+                               for shard_index in range(self.shards_count) if shard_index != self.shard_index}
+
+        servers = [await asyncio.start_server(self._handle_connection, '127.0.0.1', self.port, backlog=4096,
+                                              reuse_port=self.shards_count > 1)]
+        if self.shards_count > 1:
+            servers.append(await asyncio.start_server(self._handle_connection, '127.0.0.1',
+                                                      self._get_shard_port(self.shard_index), backlog=4096))
+        if self.metrics_port:
+            servers.append(await asyncio.start_server(self._handle_metrics_connection, '127.0.0.1', self.metrics_port))
+        if self.replication_port:
+            servers.append(await asyncio.start_server(self._handle_replica_connection, '127.0.0.1',
+                                                      self.replication_port))
+
+        timeouts_checker = asyncio.ensure_future(self._check_timeouts_periodically())
+        self.logger.info('listening on port %d, shard %d of %d', self.port, self.shard_index, self.shards_count)
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            timeouts_checker.cancel()
+
+    async def _handle_metrics_connection(self, reader, writer):
+        try:
+            # the request itself does not matter, every path returns the metrics
+            await asyncio.wait_for(reader.read(65536), self.receive_timeout)
+            writer.writelines(self._get_metrics_http_response())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_replica_connection(self, reader, writer):
+        data_ready = asyncio.Event()
 
-        match = re.match(b'(?P<command>.*?) (?P<request>.*)', task)
-        if not match:
-            raise ValueError('Wrong request')
+        def write_mutations(replica):
+            # mutations go to the standby before clients get their answers, unless it is behind
+            while not writer.transport.is_closing() and writer.transport.get_write_buffer_size() < replica.chunk_size:
+                chunk = replica.pop_chunk()
+                if chunk is None:
+                    break
+                writer.write(chunk)
+            data_ready.set()
+
+        # an overflown buffer aborts the connection, a pending drain returns then
+        replica = self._add_replica(on_data=write_mutations, on_close=writer.transport.abort)
+        # the standby sends nothing, the end of the stream means it is gone
+        standby_gone = asyncio.ensure_future(reader.read())
+        standby_gone.add_done_callback(lambda future: data_ready.set())
+        try:
+            while not replica.is_closed and not standby_gone.done():
+                chunk = replica.pop_chunk()
+                if chunk is None:
+                    data_ready.clear()
+                    await data_ready.wait()
+                    continue
+                writer.write(chunk)
+                # only this standby waits for its socket, mutations are buffered up to replica_buffer_size
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            standby_gone.cancel()
+            self._remove_replica(replica)
+            writer.close()
+
+    def _get_metrics_http_response(self):
+        body = self.get_stats([])
+        header = 'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n'
+        return header.format(len(body)).encode('utf8'), body
+
+    def _get_shard_port(self, shard_index):
+        return self.port + 1 + shard_index
+
+    async def _process_command(self, command, arguments):
+        shard_index = get_shard_index(arguments, self.shards_count)
+        if shard_index not in (None, self.shard_index):
+            return await self._request_shard(shard_index, command, arguments)
+
+        response = self.process_task(command, arguments)
+        if response == b'NONE' and get_wait_timeout(arguments):
+            return await self._get_blocking(command, arguments)
+
+        await self._wait_durable()
+        return response
+
+    async def _request_shard(self, shard_index, command, arguments):
+        """response of the owner shard, an error response if the shard connection is lost"""
+        try:
+            return await self._shard_clients[shard_index].request(command, bool(get_wait_timeout(arguments)))
+        except OSError as error:
+            return error_response(error)
+
+    async def _get_blocking(self, command, arguments):
+        """GET <queue> <timeout>: waits for a task in the queue up to timeout seconds"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + get_wait_timeout(arguments)
+        current_queue = decode_token(arguments[1])
+
+        response = self.process_task(command, arguments)
+        while response == b'NONE' and loop.time() < deadline:
+            task_waiter = loop.create_future()
+            self._task_waiters.setdefault(current_queue, collections.deque()).append(task_waiter)
+            wait_time = deadline - loop.time()
+            task_queue = self.queue_dict.get(current_queue)
+            ready_time = task_queue.next_ready_time() if task_queue is not None else None
+            if ready_time is not None:
+                # a delayed task becomes ready without any mutation waking the waiter
+                wait_time = min(wait_time, max(0, ready_time - time.time()))
+            try:
+                await asyncio.wait_for(task_waiter, wait_time)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                # a woken waiter is removed already, a timed out or cancelled one is still in the queue
+                if task_waiter.cancelled():
+                    self._remove_task_waiter(current_queue, task_waiter)
+            # another client may take the task before this one is resumed
+            response = self.process_task(command, arguments)
+
+        await self._wait_durable()
+        return response
+
+    async def _check_timeouts_periodically(self):
+        while True:
+            self.check_timeouts()
+            await asyncio.sleep(self.timeouts_check_interval)
+
+    async def _handle_connection(self, reader, writer):
+        received_size = 0
+        try:
+            try:
+                command_reader = CommandReader()
+                parsed_command = None
+                while parsed_command is None:
+                    try:
+                        data = await asyncio.wait_for(reader.read(65536), self.receive_timeout)
+                    except asyncio.TimeoutError:
+                        # whatever is received is processed, an incomplete command gets an error
+                        break
+                    if not data:
+                        break
+                    command_reader.feed(data)
+                    received_size += len(data)
+                    self._receiving_bytes += len(data)
+                    # a line command without its line feed is complete when the reader buffer is emptied
+                    parsed_command = command_reader.next_command(is_drained=len(data) < 65536)
+                    if parsed_command is None and self._is_memory_full() and \
+                            command_reader.pending_command_name() in (b'add', b'madd'):
+                        # the rest of tasks which would not fit anyway is not received
+                        self.metrics.rejected_commands += 1
+                        writer.write(b'FULL')
+                        await writer.drain()
+                        return
+                self._receiving_bytes -= received_size
+                received_size = 0
+
+                if parsed_command is None:
+                    # the stream is closed or stalled, nothing more belongs to the command
+                    parsed_command = command_reader.next_command(at_end=True)
+                    if parsed_command is None:
+                        return
+                if parsed_command[1][0] == 'pipeline':
+                    await self._serve_pipeline(reader, writer, command_reader.rest())
+                    return
+
+                response = await self._process_command(*parsed_command)
+            except ValueError as error:
+                # a wrong or incomplete command is answered, other connections are not affected
+                response = error_response(error)
+
+            writer.writelines(response_chunks(response))
+            await writer.drain()
+        finally:
+            self._receiving_bytes -= received_size
+            writer.close()
+
+    async def _serve_pipeline(self, reader, writer, data_received_from_connection):
+        """persistent connection, every command and response is a frame: <length>\\n<bytes>"""
+        writer.writelines(pack_frame(b'OK'))
+        await writer.drain()
+
+        # parsed frames are deleted once per read, not by copying the rest of the buffer after every frame
+        buffer = bytearray(data_received_from_connection)
+        self._receiving_bytes += len(buffer)
+        try:
+            while True:
+                commands = []
+                frame_end = 0
+                frame_error = None
+                try:
+                    frame = parse_frame(buffer)
+                    while frame:
+                        command, frame_end = frame
+                        commands.append(command)
+                        frame = parse_frame(buffer, frame_end)
+                except ValueError as error:
+                    # the stream can not be split into frames after a broken header
+                    frame_error = error
+                del buffer[:frame_end]
+                self._receiving_bytes -= frame_end
+
+                if commands:
+                    await self._process_pipelined_commands(writer, commands)
+                if frame_error is not None:
+                    writer.writelines(pack_frame(error_response(frame_error)))
+                    await writer.drain()
+                    return
+                if commands:
+                    continue
+
+                data = await reader.read(65536)
+                if not data:
+                    return
+                buffer += data
+                self._receiving_bytes += len(data)
+        finally:
+            self._receiving_bytes -= len(buffer)
+
+    async def _process_pipelined_commands(self, writer, commands):
+        # all pipelined commands share one flush, responses go back in the order of commands
+        responses = []
+        for command in commands:
+            try:
+                arguments = parse_complete_command(command)
+                shard_index = get_shard_index(arguments, self.shards_count)
+                if shard_index not in (None, self.shard_index):
+                    responses.append(asyncio.ensure_future(self._request_shard(shard_index, command, arguments)))
+                    continue
+
+                response = self.process_task(command, arguments)
+                if response == b'NONE' and get_wait_timeout(arguments):
+                    # parked GET does not delay the commands after it, their responses wait for it
+                    response = asyncio.ensure_future(self._get_blocking(command, arguments))
+            except ValueError as error:
+                # a wrong command gets an error in its place, commands around it are processed as usual
+                response = error_response(error)
+            responses.append(response)
+        await self._wait_durable()
+        responses = [await response if asyncio.isfuture(response) else response for response in responses]
+
+        writer.writelines(chunk for response in responses for chunk in pack_frame(response))
+        await writer.drain()
+
+    async def _wait_durable(self):
+        """returns when the journal holding the current mutations is flushed"""
+        if not self.group_commit_window:
+            self.write_file()
+            return
+
+        loop = asyncio.get_running_loop()
+        if self._batch_future is None:
+            self._batch_future = loop.create_future()
+            self._batch_timer = loop.call_later(self.group_commit_window, self._flush_batch)
+            self._batch_size = 0
+
+        batch_future = self._batch_future
+        self._batch_size += 1
+        if self._batch_size >= self.group_commit_size:
+            self._flush_batch()
+        await batch_future
 
-        command = match.group('command').decode('utf8').lower()
+    def _flush_batch(self):
+        batch_future = self._batch_future
+        self._batch_future = None
+        self._batch_timer.cancel()
 
+        self.write_file()
+        batch_future.set_result(None)
+
+    def process_task(self, command_bytes, arguments=None):
+        """arguments are parsed from command_bytes unless the caller has already parsed them"""
+        if arguments is None:
+            arguments = parse_complete_command(command_bytes)
+
+        if self._log_requests:
+            self._requests_count += 1
+            if int(self._requests_count * self._log_sample_rate) > \
+                    int((self._requests_count - 1) * self._log_sample_rate):
+                return self._process_task_logged(command_bytes, arguments)
+
+        return self._process_task(arguments)
+
+    def _process_task_logged(self, command_bytes, arguments):
+        start_time = time.perf_counter()
+        response = self._process_task(arguments)
+        self.logger.info('%s: %d bytes, response %d bytes, %.3f ms', arguments[0], len(command_bytes),
+                         sum(len(chunk) for chunk in response_chunks(response)),
+                         (time.perf_counter() - start_time) * 1000)
+        # payloads may be large, only their beginning is written
+        self.logger.debug('request %r, response %r', bytes(command_bytes[:64]),
+                          bytes(response_chunks(response)[0][:64]))
+        return response
+
+    def _process_task(self, arguments):
+        command = arguments[0]
         processing_function = self._func_dict.get(command)
         if not processing_function:
             raise ValueError('Wrong command.')
 
-        request = match.group('request').lower().strip()
-        response = processing_function(request)
+        start_time = time.perf_counter()
+        response = processing_function(arguments[1:])
+        self.metrics.observe_command(command, time.perf_counter() - start_time)
         return response
 
-    def add_task(self, request):
-        match_req = re.match(b'^(?P<queue>\S+)\s+(?P<length>\d+)\s+(?P<data>\S+)$', request)  # TODO: data type
-        if not match_req:
-            raise ValueError('Wrong request structure')
+    def add_task(self, arguments):
+        """ADD <queue> [priority=<integer>] [not_before=<timestamp>] <length> <data>"""
+        current_queue, *options, (length, data) = arguments
+        current_queue = decode_token(current_queue)
+        if not self._admit(current_queue, 1, len(data)):
+            return b'FULL'
+        return self._add(current_queue, length, data, self._parse_add_options(options))
 
-        current_queue = match_req.group('queue').decode('utf8')
+    def _is_memory_full(self):
+        return self.max_bytes is not None and self._stored_bytes + self._receiving_bytes >= self.max_bytes
 
-        if current_queue not in self.queue_dict:
-            self.queue_dict[current_queue] = []
-
-        task_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=10))
-        for task_item in self.queue_dict[current_queue]:
-            if task_id in task_item['id']:
-                task_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
-        self.queue_dict[current_queue].append(
-            {
-                'id': task_id,
-                'length': match_req.group('length').decode('utf8'),
-                'data': list(match_req.group('data')),
-                'is_available': True
-            }
-        )
+    def _admit(self, current_queue, tasks_count, tasks_bytes):
+        """checks that new tasks fit into queue and global limits, counts the rejected command"""
+        task_queue = self.queue_dict.get(current_queue)
+        queue_tasks, queue_bytes = (len(task_queue), task_queue.payload_bytes) if task_queue is not None else (0, 0)
+        # bytes of other commands which are being received may become tasks soon as well
+        admitted = (self.max_queue_tasks is None or queue_tasks + tasks_count <= self.max_queue_tasks) and \
+            (self.max_queue_bytes is None or queue_bytes + tasks_bytes <= self.max_queue_bytes) and \
+            (self.max_tasks is None or self._stored_tasks + tasks_count <= self.max_tasks) and \
+            (self.max_bytes is None or self._stored_bytes + self._receiving_bytes + tasks_bytes <= self.max_bytes)
+        if not admitted:
+            self.metrics.rejected_commands += 1
+        return admitted
+
+    @staticmethod
+    def _parse_add_options(options):
+        """tasks with a higher priority are given first, not_before is a unix timestamp"""
+        add_options = {}
+        for option in options:
+            name, value = option.split(b'=', 1)
+            name = name.lower()
+            try:
+                if name == b'priority':
+                    add_options['priority'] = int(value)
+                elif name == b'not_before':
+                    add_options['not_before'] = float(value)
+                    # nan and inf would break the order of delayed tasks
+                    if not math.isfinite(add_options['not_before']):
+                        raise ValueError
+                else:
+                    raise ValueError
+            except ValueError:
+                raise ValueError('Wrong option {}'.format(option.decode('utf8', 'replace')))
+        return add_options
+
+    def _next_task_id(self):
+        """<shard>-<sequence number of the add record>, unique without looking at existing tasks
+
+        The journal sequence number is kept by snapshots, so it grows across restarts and compactions.
+        Numbers of records lost in a crash may be used again, but nobody got an answer with them.
+        Fixed width hex keeps ids of a shard ordered as strings, '-' separates them from old random ids.
+        """
+        return '{}-{:016x}'.format(self.shard_index, self.journal.last_seq + 1)
+
+    def _add(self, current_queue, length, data, add_options):
+        task_id = self._next_task_id()
+        record = {
+            'op': 'add',
+            'queue': current_queue,
+            'id': task_id,
+            'length': length.decode('utf8'),
+            # a view would keep the whole received command alive, MADD payloads included
+            'data': bytes(data)
+        }
+        record.update(add_options)
+        self._commit(record)
 
         return task_id.encode('utf-8')
 
-    def get_task(self, request):
-        request = request.decode('utf8')
+    def add_tasks(self, arguments):
+        """MADD <queue> [<option>=<value> ...] <count> <length> <data> ... <length> <data>,
+        responds with ids separated by spaces"""
+        current_queue, *arguments = arguments
+        options = [argument for argument in arguments if isinstance(argument, bytes) and b'=' in argument]
+        count, tasks = arguments[len(options)], arguments[len(options) + 1:]
+        if int(count) > self.max_batch_size:
+            raise ValueError('Too many tasks in a batch')
 
-        match_req = re.match(r'^(?P<queue>\S+)$', request)
-        if not match_req:
+        current_queue = decode_token(current_queue)
+        if not self._admit(current_queue, len(tasks), sum(len(data) for length, data in tasks)):
+            return b'FULL'
+        add_options = self._parse_add_options(options)
+        return b' '.join(self._add(current_queue, length, data, add_options) for length, data in tasks)
+
+    def get_task(self, arguments):
+        # the optional timeout of a blocking GET is handled by the asyncio server, here it is just NONE
+        if len(arguments) > 1 and not arguments[1].replace(b'.', b'', 1).isdigit():
             raise ValueError('Wrong request structure')
 
-        current_queue = match_req.group('queue')
+        # the background check may not have run yet for a task which has just timed out
+        self.check_timeouts()
+
+        current_queue = decode_token(arguments[0])
         if current_queue not in self.queue_dict:
             return b'NONE'
 
-        for task_item in self.queue_dict[current_queue]:
-            if task_item['is_available']:
-                task_item['is_available'] = False
-                self.timeouts_list.append({'queue': current_queue, 'id': task_item['id'], 'timestamp': time.time()})
-                return '{} {} '.format(task_item['id'], task_item['length']).encode('utf8') + bytes(task_item['data'])
-            else:
-                continue
-
-        return b'NONE'
+        task_item = self.queue_dict[current_queue].first_available()
+        if task_item is None:
+            return b'NONE'
 
-    def ack_status(self, request):
-        request = request.decode('utf8')
+        self._commit({'op': 'get', 'queue': current_queue, 'id': task_item['id'], 'timestamp': time.time()})
+        return '{} {} '.format(task_item['id'], task_item['length']).encode('utf8'), \
+            self.queue_dict[current_queue].payload(task_item)
 
-        match_req = re.match(r'^(?P<queue>\S+)\s+(?P<id>\S+)$', request)
-        if not match_req:
+    def get_tasks(self, arguments):
+        """MGET <queue> <count>, responds with up to count tasks as <id> <length> <data> separated by spaces"""
+        current_queue, count = arguments
+        if not count.isdigit():
             raise ValueError('Wrong request structure')
-        current_queue_tasks = self.queue_dict.get(match_req.group('queue'))
-        task_index = 0
-        for task in current_queue_tasks:
-            if task['id'] == match_req.group('id'):
-                del (self.queue_dict[match_req.group('queue')][task_index])
-                self._remove_task_from_timeouts_list(match_req.group('id'))
-                return b'YES'
-            else:
-                task_index += 1
-        return b'NO'
-
-    def _remove_task_from_timeouts_list(self, task_id):
-        for task_index in range(len(self.timeouts_list)):
-            if self.timeouts_list[task_index]['id'] == task_id:
-                del self.timeouts_list[task_index]
-
-    def in_queue(self, request):
-        request = request.decode('utf8')
-
-        match_req = re.match(r'^(?P<queue>\S+)\s+(?P<id>\S+)$', request)
-        if not match_req:
+
+        response = []
+        for _ in range(min(int(count), self.max_batch_size)):
+            task_response = self.get_task([current_queue])
+            if task_response == b'NONE':
+                break
+            header, data = task_response
+            response.extend([b' ' + header if response else header, data])
+
+        if not response:
+            return b'NONE'
+        return tuple(response)
+
+    def ack_status(self, arguments):
+        current_queue, task_id = decode_token(arguments[0]), decode_token(arguments[1])
+        current_queue_tasks = self.queue_dict.get(current_queue)
+        if current_queue_tasks is None or task_id not in current_queue_tasks:
+            return b'NO'
+
+        self._commit({'op': 'ack', 'queue': current_queue, 'id': task_id})
+        return b'YES'
+
+    def ack_statuses(self, arguments):
+        """MACK <queue> <count> <id> ... <id>, responds with YES or NO for every id"""
+        current_queue, count, *task_ids = arguments
+        if len(task_ids) > self.max_batch_size:
             raise ValueError('Wrong request structure')
 
-        current_queue_tasks = self.queue_dict.get(match_req.group('queue'))
-        for task in current_queue_tasks:
-            if task['id'] == match_req.group('id'):
-                return b'YES'
-        return b'NO'
+        return b' '.join(self.ack_status([current_queue, task_id]) for task_id in task_ids)
+
+    def get_stats(self, arguments):
+        """STATS, responds with metrics in the prometheus text format"""
+        gauges = []
+        # sizes of queues which are not loaded yet come from the snapshot index
+        queue_sizes = sorted(self.queue_dict.sizes())
+        for queue_name, tasks_count, _, _ in queue_sizes:
+            gauges.append(('task_queue_tasks', format_label('queue', queue_name), tasks_count))
+        for queue_name, _, in_flight_count, _ in queue_sizes:
+            gauges.append(('task_queue_in_flight_tasks', format_label('queue', queue_name), in_flight_count))
+        for queue_name, _, _, payload_bytes in queue_sizes:
+            gauges.append(('task_queue_payload_bytes', format_label('queue', queue_name), payload_bytes))
+        gauges.append(('task_queue_receiving_bytes', '', self._receiving_bytes))
+        gauges.append(('task_queue_unloaded_queues', '', self.queue_dict.unloaded_count()))
+        gauges.append(('task_queue_payload_memory_bytes', '', self.payload_store.memory_size))
+        gauges.append(('task_queue_payload_segments', '', len(self.payload_store.segments)))
+        gauges.append(('task_queue_journal_records', '', self.journal.records_count))
+        gauges.append(('task_queue_replicas', '', len(self._replicas)))
+        return self.metrics.render(gauges)
+
+    def in_queue(self, arguments):
+        current_queue, task_id = decode_token(arguments[0]), decode_token(arguments[1])
+        current_queue_tasks = self.queue_dict.get(current_queue)
+        if current_queue_tasks is None or task_id not in current_queue_tasks:
+            return b'NO'
+        return b'YES'
+
+
+def parse_sample_rate(value):
+    """argparse type of a part of requests, zero would be dropped as an unset option"""
+    rate = float(value)
+    if not 0 < rate <= 1:
+        raise argparse.ArgumentTypeError('{} is not in (0, 1]'.format(value))
+    return rate
 
 
 def parse_args():
@@ -194,8 +1023,44 @@ def parse_args():
                         help='port, where server will be located')
     # parser.add_argument('--backup_remove', type=bool, default=False,
     #                     help='remove backup file on exit')
-    parser.add_argument('--backup_path', type=str,
+    parser.add_argument('--backup_path', type=str, dest='backup_file_path',
                         help='path to backup file')
+    parser.add_argument('--compaction_threshold', type=int,
+                        help='number of journal records after which a new snapshot is written')
+    parser.add_argument('--group_commit_window', type=float,
+                        help='seconds to collect mutations sharing one disk flush, 0 disables group commit')
+    parser.add_argument('--group_commit_size', type=int,
+                        help='max number of commands sharing one disk flush')
+    parser.add_argument('--payload_memory_limit', type=int,
+                        help='bytes of task payloads kept in memory, the rest is stored in memory-mapped files')
+    parser.add_argument('--payload_dir', type=str,
+                        help='directory for memory-mapped payload segments, its *.segment files are removed on start')
+    parser.add_argument('--max_batch_size', type=int,
+                        help='max number of tasks in MADD, MGET and MACK commands')
+    parser.add_argument('--workers', type=int, dest='shards_count',
+                        help='number of processes, each of them owns a part of queues')
+    parser.add_argument('--log_level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='logging is off without this option')
+    parser.add_argument('--log_sample_rate', type=parse_sample_rate,
+                        help='part of requests written to the log, e.g. 0.01 for every hundredth')
+    parser.add_argument('--metrics_port', type=int,
+                        help='port of the http endpoint with metrics in the prometheus text format')
+    parser.add_argument('--replication_port', type=int,
+                        help='port for standbys, they get the state and every flushed mutation of this server')
+    parser.add_argument('--replicate_from', type=int,
+                        help='replication port of the primary, this server is its standby until it is lost')
+    parser.add_argument('--replica_buffer_size', type=int,
+                        help='max bytes of mutations waiting for a standby, a slower standby is disconnected')
+    parser.add_argument('--max_queue_tasks', type=int,
+                        help='max number of tasks in a queue, ADD is answered with FULL above it')
+    parser.add_argument('--max_queue_bytes', type=int,
+                        help='max bytes of task payloads in a queue')
+    parser.add_argument('--max_tasks', type=int,
+                        help='max number of tasks in all queues of a process')
+    parser.add_argument('--max_bytes', type=int,
+                        help='max bytes of task payloads in all queues of a process, including commands being received')
+    parser.add_argument('--async', action='store_true', dest='use_async',
+                        help='serve connections concurrently with asyncio')
     parser.add_argument('--task_timeout', type=int,
                         help='timeout on given task')
 
@@ -215,9 +1080,21 @@ def create_kwargs_for_server(args_from_argsparse):
     return kwargs
 
 
+def run_server(kwargs_for_server):
+    use_async = kwargs_for_server.pop('use_async', False)
+
+    kwargs_for_server.setdefault('backup_file_path', 'backup.json')
+    check_backup_layout(kwargs_for_server['backup_file_path'], kwargs_for_server.get('shards_count', 1))
+    if kwargs_for_server.get('shards_count', 1) > 1:
+        run_sharded(Server, kwargs_for_server.pop('shards_count'), kwargs_for_server)
+    else:
+        server1 = Server(**kwargs_for_server)
+        if use_async:
+            server1.run_async()
+        else:
+            server1.run()
+
+
 if __name__ == '__main__':
     parsed_args = parse_args()
-    kwargs_for_server = create_kwargs_for_server(parsed_args)
-
-    server1 = Server(**kwargs_for_server)
-    server1.run()
+    run_server(create_kwargs_for_server(parsed_args))
@@ -0,0 +1,166 @@
+import os
+import sys
+import zlib
+import signal
+import asyncio
+import collections
+import multiprocessing
+
+from journal import read_records
+from protocol import parse_frame, pack_frame, decode_token
+
+
+def get_shard_index(arguments, shards_count):
+    """owner shard of the command queue, None if the command may be processed by any shard
+
+    Queue names are partitioned by crc32, python hash() differs between processes.
+    """
+    if shards_count == 1:
+        return None
+
+    # commands without a queue, like STATS, are processed by the shard which received them
+    if len(arguments) < 2:
+        return None
+    return get_queue_shard_index(decode_token(arguments[1]), shards_count)
+
+
+def get_queue_shard_index(queue_name, shards_count):
+    """owner shard of the queue name, which is lowercased already like all queue names"""
+    return zlib.crc32(queue_name.encode('utf8')) % shards_count
+
+
+def get_shard_backup_path(backup_file_path, shard_index):
+    root, extension = os.path.splitext(backup_file_path)
+    return '{}.{}{}'.format(root, shard_index, extension)
+
+
+def check_backup_layout(backup_file_path, shards_count):
+    """raises ValueError if backups were written with another number of shards
+
+    Queues are partitioned by the number of shards, with another number a shard would not find
+    queues of its backup and tasks of some backups would not be served at all.
+    """
+    if shards_count == 1:
+        foreign_paths = [get_shard_backup_path(backup_file_path, 0)]
+    else:
+        foreign_paths = [backup_file_path, get_shard_backup_path(backup_file_path, shards_count)]
+    for path in foreign_paths:
+        if os.path.exists(path) or os.path.exists(path + '.journal'):
+            raise ValueError('{} is written with another number of workers'.format(path))
+
+    if shards_count == 1:
+        return
+    for shard_index in range(shards_count):
+        path = get_shard_backup_path(backup_file_path, shard_index)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as backup_file:
+            if backup_file.peek(1)[:1] == b'{':
+                raise ValueError('{} is written without workers'.format(path))
+            snapshot_header, _ = next(read_records(backup_file))
+        if snapshot_header.get('shards_count', shards_count) != shards_count:
+            raise ValueError('{} is written by {} workers'.format(path, snapshot_header['shards_count']))
+
+
+class ShardClient:
+    """pipelined connection to another shard, responses are matched to requests by their order"""
+
+    def __init__(self, port, connect_timeout=5):
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self._writer = None
+        self._waiting_futures = collections.deque()
+        self._connect_lock = asyncio.Lock()
+
+    async def request(self, command, is_blocking=False):
+        if is_blocking:
+            # a parked GET would hold responses of all other clients sharing the pipelined connection
+            return await self._request_separately(command)
+
+        if self._writer is None:
+            async with self._connect_lock:
+                if self._writer is None:
+                    await self._connect()
+
+        response_future = asyncio.get_running_loop().create_future()
+        self._waiting_futures.append(response_future)
+        self._writer.writelines(pack_frame(command))
+        return await response_future
+
+    async def _request_separately(self, command):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            writer.write(command)
+            # the command ends with the stream, the shard does not wait for more of it
+            writer.write_eof()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                break
+            except OSError:
+                # the shard process may still be starting
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+        writer.write(b'PIPELINE\n')
+        self._waiting_futures.append(loop.create_future())
+        asyncio.ensure_future(self._read_responses(reader, writer))
+        self._writer = writer
+
+    async def _read_responses(self, reader, writer):
+        data_received = bytearray()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                data_received += data
+
+                frame_end = 0
+                frame = parse_frame(data_received)
+                while frame:
+                    response, frame_end = frame
+                    self._waiting_futures.popleft().set_result(response)
+                    frame = parse_frame(data_received, frame_end)
+                del data_received[:frame_end]
+        except (OSError, ValueError):
+            # requests which are sent already can not be matched to responses any more
+            pass
+        finally:
+            writer.close()
+            self._writer = None
+            while self._waiting_futures:
+                self._waiting_futures.popleft().set_exception(ConnectionError('Shard connection closed'))
+
+
+def run_shard(server_class, shard_index, shards_count, server_kwargs):
+    server_kwargs = dict(server_kwargs,
+                         shard_index=shard_index,
+                         shards_count=shards_count,
+                         backup_file_path=get_shard_backup_path(server_kwargs['backup_file_path'], shard_index))
+    server_class(**server_kwargs).run_async()
+
+
+def run_sharded(server_class, shards_count, server_kwargs):
+    """starts a process per shard, all of them accept clients on the same port with SO_REUSEPORT"""
+    processes = [multiprocessing.Process(target=run_shard, args=(server_class, shard_index, shards_count, server_kwargs))
+                 for shard_index in range(shards_count)]
+    for process in processes:
+        process.start()
+
+    # terminating the main process stops the shards as well
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,354 @@
+import os
+import mmap
+import time
+import heapq
+import itertools
+
+from journal import write_record, read_records
+
+
+class PayloadStore:
+    """task payloads: in memory up to memory_limit bytes, the rest in memory-mapped segment files
+
+    Segment files are only a cache, payloads are durable in the journal and snapshots,
+    so segments are recreated from scratch on every start.
+    """
+
+    def __init__(self, directory=None, memory_limit=None, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+        self.memory_size = 0
+        self.segments = {}
+        self._active_segment_id = None
+        self._next_segment_id = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            # only segments left by a previous run are removed, the directory may hold other files
+            for file_name in os.listdir(self.directory):
+                file_path = os.path.join(self.directory, file_name)
+                if file_name.endswith('.segment') and os.path.isfile(file_path):
+                    os.remove(file_path)
+
+    def put(self, data):
+        """returns a handle of the payload: the data itself or (segment id, offset, length)"""
+        if self.memory_limit is None or self.memory_size + len(data) <= self.memory_limit or not data:
+            self.memory_size += len(data)
+            return data
+
+        segment = self._get_active_segment(len(data))
+        offset = segment['used']
+        segment['mmap'][offset:offset + len(data)] = data
+        segment['used'] += len(data)
+        segment['live'] += 1
+        return self._active_segment_id, offset, len(data)
+
+    def get(self, handle):
+        if not isinstance(handle, tuple):
+            return handle
+
+        segment_id, offset, length = handle
+        return memoryview(self.segments[segment_id]['mmap'])[offset:offset + length]
+
+    def release(self, handle):
+        if not isinstance(handle, tuple):
+            self.memory_size -= len(handle)
+            return
+
+        segment_id = handle[0]
+        segment = self.segments[segment_id]
+        segment['live'] -= 1
+        if not segment['live'] and segment_id != self._active_segment_id:
+            self._remove_segment(segment_id)
+
+    def _get_active_segment(self, data_size):
+        segment = self.segments.get(self._active_segment_id)
+        if segment is not None and segment['used'] + data_size <= len(segment['mmap']):
+            return segment
+
+        previous_segment_id = self._active_segment_id
+        self._active_segment_id = self._next_segment_id
+        self._next_segment_id += 1
+        if segment is not None and not segment['live']:
+            self._remove_segment(previous_segment_id)
+
+        segment_path = os.path.join(self.directory, '{}.segment'.format(self._active_segment_id))
+        segment_size = max(self.segment_size, data_size)
+        with open(segment_path, 'w+b') as segment_file:
+            segment_file.truncate(segment_size)
+            segment_mmap = mmap.mmap(segment_file.fileno(), segment_size)
+
+        segment = {'path': segment_path, 'mmap': segment_mmap, 'used': 0, 'live': 0}
+        self.segments[self._active_segment_id] = segment
+        return segment
+
+    def _remove_segment(self, segment_id):
+        segment = self.segments.pop(segment_id)
+        os.remove(segment['path'])
+        try:
+            segment['mmap'].close()
+        except BufferError:
+            # a response is still being sent from this segment, the mapping is freed with the last view
+            pass
+
+
+class TaskQueue:
+    """tasks of one queue: id index, available tasks by priority and order of adding, delayed tasks
+    and tasks given to workers"""
+
+    def __init__(self, payload_store=None):
+        self.payload_store = payload_store or PayloadStore()
+        self.tasks = {}
+        self.in_flight = set()
+        # (-priority, order, id), entries of taken or acknowledged tasks are skipped lazily
+        self._available_heap = []
+        # (not before, order, id) of tasks which are not ready yet
+        self._delayed_heap = []
+        self._next_order = 0
+        # sum of task lengths, for quotas
+        self.payload_bytes = 0
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task_id, length, data, priority=0, not_before=0):
+        """tasks with a higher priority are given first, a task is not given before the not_before timestamp"""
+        task = {'id': task_id, 'length': length, 'data': self.payload_store.put(data), 'order': self._next_order,
+                'priority': priority, 'not_before': not_before}
+        self._next_order += 1
+        self.tasks[task_id] = task
+        self.payload_bytes += int(length)
+        if not_before:
+            heapq.heappush(self._delayed_heap, (not_before, task['order'], task_id))
+        else:
+            self._push_available(task)
+        return task
+
+    def _push_available(self, task):
+        heapq.heappush(self._available_heap, (-task['priority'], task['order'], task['id']))
+
+    def get(self, task_id):
+        return self.tasks.get(task_id)
+
+    def payload(self, task):
+        return self.payload_store.get(task['data'])
+
+    def first_available(self, now=None):
+        """the oldest task of the highest priority which is ready and not given to a worker, None if there is
+        no such task"""
+        now = time.time() if now is None else now
+        while self._delayed_heap and self._delayed_heap[0][0] <= now:
+            task_id = heapq.heappop(self._delayed_heap)[2]
+            if task_id in self.tasks:
+                self._push_available(self.tasks[task_id])
+
+        while self._available_heap:
+            task_id = self._available_heap[0][2]
+            if task_id in self.tasks and task_id not in self.in_flight:
+                return self.tasks[task_id]
+            heapq.heappop(self._available_heap)
+        return None
+
+    def next_ready_time(self):
+        """the earliest not_before timestamp of delayed tasks, None if there are no such tasks"""
+        while self._delayed_heap and self._delayed_heap[0][2] not in self.tasks:
+            heapq.heappop(self._delayed_heap)
+        return self._delayed_heap[0][0] if self._delayed_heap else None
+
+    def take(self, task_id):
+        if task_id not in self.tasks:
+            return
+        if self._available_heap and self._available_heap[0][2] == task_id:
+            heapq.heappop(self._available_heap)
+        self.in_flight.add(task_id)
+
+    def release(self, task_id):
+        """returns a timed out task, it keeps its place in the order of adding within its priority"""
+        if task_id not in self.in_flight:
+            return
+        self.in_flight.discard(task_id)
+        self._push_available(self.tasks[task_id])
+
+    def remove(self, task_id):
+        """returns the removed task, None if there is no such task"""
+        task = self.tasks.pop(task_id, None)
+        if task is None:
+            return None
+        self.in_flight.discard(task_id)
+        self.payload_store.release(task['data'])
+        self.payload_bytes -= int(task['length'])
+        return task
+
+    def to_list(self):
+        return [
+            {
+                'id': task['id'],
+                'length': task['length'],
+                'data': self.payload(task),
+                'is_available': task['id'] not in self.in_flight,
+                'priority': task['priority'],
+                'not_before': task['not_before']
+            }
+            for task in self.tasks.values()
+        ]
+
+    def restore(self, task):
+        """adds a task of to_list(), the payload goes to the payload store at once"""
+        self.add(task['id'], task['length'], task['data'], task.get('priority', 0), task.get('not_before', 0))
+        if not task['is_available']:
+            self.take(task['id'])
+
+    @classmethod
+    def from_list(cls, tasks, payload_store=None):
+        """tasks may be an iterator, they are restored one by one"""
+        task_queue = cls(payload_store)
+        for task in tasks:
+            task_queue.restore(task)
+        return task_queue
+
+
+class QueueDict:
+    """queues by name, queues of an indexed snapshot stay in the memory-mapped file until the first access"""
+
+    def __init__(self, payload_store=None):
+        self.payload_store = payload_store or PayloadStore()
+        self._queues = {}
+        self._snapshot = None
+        # queue name: [offset, size, tasks count, in flight tasks count, payload bytes] of its records in the snapshot
+        self._snapshot_index = {}
+
+    def attach_snapshot(self, snapshot_path, index):
+        """queues of the index which are not in memory are read from the snapshot when they are needed"""
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshot = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._close_snapshot()
+        self._snapshot = snapshot
+        self._snapshot_index = {queue_name: entry for queue_name, entry in index.items()
+                                if queue_name not in self._queues}
+
+    def _close_snapshot(self):
+        if self._snapshot is None:
+            return
+        try:
+            self._snapshot.close()
+        except BufferError:
+            # the mapping is freed with the last view
+            pass
+        self._snapshot = None
+
+    def _load(self, queue_name):
+        offset, size, tasks_count, in_flight_count, payload_bytes = self._snapshot_index.pop(queue_name)
+        self._snapshot.seek(offset)
+        tasks = (task for task, _ in itertools.islice(read_records(self._snapshot), tasks_count))
+        self._queues[queue_name] = TaskQueue.from_list(tasks, self.payload_store)
+        if not self._snapshot_index:
+            self._close_snapshot()
+
+    def is_loaded(self, queue_name):
+        return queue_name not in self._snapshot_index
+
+    def unloaded_count(self):
+        return len(self._snapshot_index)
+
+    def __contains__(self, queue_name):
+        return queue_name in self._queues or queue_name in self._snapshot_index
+
+    def __len__(self):
+        return len(self._queues) + len(self._snapshot_index)
+
+    def __getitem__(self, queue_name):
+        if queue_name in self._snapshot_index:
+            self._load(queue_name)
+        return self._queues[queue_name]
+
+    def __setitem__(self, queue_name, task_queue):
+        self._snapshot_index.pop(queue_name, None)
+        self._queues[queue_name] = task_queue
+
+    def get(self, queue_name, default=None):
+        if queue_name in self._snapshot_index:
+            self._load(queue_name)
+        return self._queues.get(queue_name, default)
+
+    def names(self):
+        return list(self._queues) + list(self._snapshot_index)
+
+    def items(self):
+        """loads all queues"""
+        for queue_name in list(self._snapshot_index):
+            self._load(queue_name)
+        return self._queues.items()
+
+    def values(self):
+        return [task_queue for queue_name, task_queue in self.items()]
+
+    def sizes(self):
+        """(name, tasks count, in flight tasks count, payload bytes) of every queue without loading them"""
+        for queue_name, task_queue in self._queues.items():
+            yield queue_name, len(task_queue), len(task_queue.in_flight), task_queue.payload_bytes
+        for queue_name, (offset, size, tasks_count, in_flight_count, payload_bytes) in self._snapshot_index.items():
+            yield queue_name, tasks_count, in_flight_count, payload_bytes
+
+    def write_queue(self, output_file, queue_name):
+        """writes task records of the queue, records of a queue which is not loaded are copied as they are"""
+        if queue_name in self._snapshot_index:
+            offset, size, tasks_count, in_flight_count, payload_bytes = self._snapshot_index[queue_name]
+            with memoryview(self._snapshot) as snapshot_view:
+                output_file.write(snapshot_view[offset:offset + size])
+            return tasks_count, in_flight_count, payload_bytes
+
+        task_queue = self._queues[queue_name]
+        for task in task_queue.to_list():
+            task['queue'] = queue_name
+            write_record(output_file, task)
+        return len(task_queue), len(task_queue.in_flight), task_queue.payload_bytes
+
+
+class ExpiryScheduler:
+    """given tasks in a min-heap by the time they were given, cancelled entries are skipped lazily"""
+
+    def __init__(self):
+        self._heap = []
+        self._given_at = {}
+
+    def __len__(self):
+        return len(self._given_at)
+
+    def schedule(self, queue_name, task_id, timestamp):
+        self._given_at[(queue_name, task_id)] = timestamp
+        heapq.heappush(self._heap, (timestamp, queue_name, task_id))
+
+    def cancel(self, queue_name, task_id):
+        self._given_at.pop((queue_name, task_id), None)
+
+    def has_expired(self, given_before):
+        while self._heap:
+            timestamp, queue_name, task_id = self._heap[0]
+            if self._given_at.get((queue_name, task_id)) == timestamp:
+                return timestamp <= given_before
+            heapq.heappop(self._heap)
+        return False
+
+    def pop_expired(self, given_before):
+        """(queue, id) pairs of tasks given not later than given_before, oldest first"""
+        expired_tasks = []
+        while self.has_expired(given_before):
+            timestamp, queue_name, task_id = heapq.heappop(self._heap)
+            del self._given_at[(queue_name, task_id)]
+            expired_tasks.append((queue_name, task_id))
+        return expired_tasks
+
+    def to_list(self):
+        return [{'queue': queue_name, 'id': task_id, 'timestamp': timestamp}
+                for (queue_name, task_id), timestamp in sorted(self._given_at.items(), key=lambda item: item[1])]
+
+    @classmethod
+    def from_list(cls, timeouts_list):
+        scheduler = cls()
+        for given_task in timeouts_list:
+            scheduler.schedule(given_task['queue'], given_task['id'], given_task['timestamp'])
+        return scheduler
@@ -1,10 +1,22 @@
 from unittest import TestCase
 
+import os
+import json
 import time
 import socket
+import signal
+import struct
+import asyncio
+import argparse
+import tempfile
 
 import subprocess
 
+from server import Server, response_chunks, parse_sample_rate
+from sharding import get_queue_shard_index, get_shard_backup_path, check_backup_layout
+from storage import TaskQueue, ExpiryScheduler, PayloadStore
+from protocol import parse_command, CommandReader
+
 
 class ServerBaseTest(TestCase):
     def setUp(self):
@@ -51,6 +63,59 @@ class ServerBaseTest(TestCase):
         self.assertEqual(b'YES', self.send(b'ACK 1 ' + first_task_id))
         self.assertEqual(b'NO', self.send(b'ACK 1 ' + first_task_id))
 
+    def test_stats(self):
+        task_id = self.send(b'ADD stats 5 12345')
+        self.send(b'GET stats')
+        stats = self.send(b'STATS').decode('utf8')
+        self.assertIn('task_queue_tasks{queue="stats"} 1', stats)
+        self.assertIn('task_queue_in_flight_tasks{queue="stats"} 1', stats)
+        self.assertIn('task_queue_command_seconds_count{command="add"}', stats)
+        self.assertEqual(b'YES', self.send(b'ACK stats ' + task_id))
+
+    def test_batch_commands(self):
+        task_ids = self.send(b'MADD 1 3 5 12345 1 6 3 7 8').split()
+        self.assertEqual(3, len(task_ids))
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + task_ids[2]))
+
+        self.assertEqual(b' '.join([task_ids[0], b'5 12345', task_ids[1], b'1 6']), self.send(b'MGET 1 2'))
+        self.assertEqual(task_ids[2] + b' 3 7 8', self.send(b'MGET 1 5'))
+        self.assertEqual(b'NONE', self.send(b'MGET 1 5'))
+
+        self.assertEqual(b'YES NO YES YES', self.send(b'MACK 1 4 ' + b' '.join([task_ids[0], b'unknown'] + task_ids[1:])))
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + task_ids[1]))
+
+    def test_line_commands_without_line_feed(self):
+        # clients of the original protocol do not end a command with a line feed
+        task_id = self.send(b'ADD 1 5 12345')
+        started_at = time.time()
+        for _ in range(50):
+            self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
+        self.assertLess(time.time() - started_at, 1)
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+    def test_reset_connections(self):
+        for command in [b'IN 1 a', b'GET 1'] * 10:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # close() resets the connection instead of finishing it
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            s.connect(('127.0.0.1', 5555))
+            s.send(command)
+            s.close()
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+
+    def test_wrong_commands(self):
+        self.assertTrue(self.send(b'FOO 1').startswith(b'ERROR'))
+        # the rest of the payload never comes, the command is incomplete
+        self.assertTrue(self.send(b'ADD 1 10 123').startswith(b'ERROR'))
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+    def test_wrong_options(self):
+        for command in [b'ADD 1 priority=high 1 a', b'ADD 1 color=red 1 a', b'MADD 1 not_before=nan 1 1 a']:
+            self.assertEqual(b'ERROR Wrong option ' + command.split()[2], self.send(command))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+
 
 class ServerTimeoutTest(TestCase):
     """ tasks timeout testing """
@@ -80,3 +145,753 @@ class ServerTimeoutTest(TestCase):
         self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
         self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
         self.assertEqual(b'NO', self.send(b'IN 1 ' + task_id))
+
+
+class ServerGroupCommitTest(TestCase):
+    """ responses are held until the batch is flushed """
+    def setUp(self):
+        self.server = subprocess.Popen(['python', 'server.py', '--group_commit_window', '0.05'])
+        # даем серверу время на запуск
+        time.sleep(0.5)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+
+    def send(self, command):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.send(command)
+        data = s.recv(1000000)
+        s.close()
+        return data
+
+    def test_base_scenario(self):
+        start_time = time.time()
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertGreaterEqual(time.time() - start_time, 0.05)
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + task_id))
+
+
+class ServerAsyncTest(TestCase):
+    """ concurrent connections in asyncio mode """
+    def setUp(self):
+        self.server = subprocess.Popen(['python', 'server.py', '--async', '--metrics_port', '5600'])
+        self.metrics_ports = [5600]
+        # даем серверу время на запуск
+        time.sleep(0.5)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        return s
+
+    def send(self, command):
+        s = self.connect()
+        s.send(command)
+        data = s.recv(1000000)
+        s.close()
+        return data
+
+    def test_base_scenario(self):
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + task_id))
+
+    def test_wrong_commands(self):
+        self.assertTrue(self.send(b'FOO 1').startswith(b'ERROR'))
+        self.assertTrue(self.send(b'ADD 1 10 123').startswith(b'ERROR'))
+        self.assertTrue(self.send(b'GET 1 soon').startswith(b'ERROR'))
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+    def test_wrong_options(self):
+        for command in [b'ADD 1 priority=high 1 a', b'ADD 1 color=red 1 a', b'MADD 1 not_before=nan 1 1 a']:
+            self.assertEqual(b'ERROR Wrong option ' + command.split()[2], self.send(command))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+
+    def test_line_commands_without_line_feed(self):
+        task_id = self.send(b'ADD 1 5 12345')
+        started_at = time.time()
+        for _ in range(50):
+            self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
+        self.assertLess(time.time() - started_at, 1)
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+    def test_slow_sender_does_not_block_others(self):
+        slow_connection = self.connect()
+        slow_connection.send(b'ADD 1 10 12345')
+
+        task_id = self.send(b'ADD 2 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 2'))
+        self.assertEqual(b'YES', self.send(b'ACK 2 ' + task_id))
+
+        slow_connection.send(b'67890')
+        slow_task_id = slow_connection.recv(1000)
+        slow_connection.close()
+        self.assertEqual(slow_task_id + b' 10 1234567890', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + slow_task_id))
+
+    def test_many_connections(self):
+        connections = [self.connect() for _ in range(200)]
+        for connection in connections:
+            connection.send(b'ADD 3 5 12345')
+        task_ids = [connection.recv(1000) for connection in connections]
+        for connection in connections:
+            connection.close()
+
+        self.assertEqual(200, len(set(task_ids)))
+        for task_id in task_ids:
+            self.assertEqual(b'YES', self.send(b'ACK 3 ' + task_id))
+
+    def test_metrics_endpoint(self):
+        self.send(b'ADD 7 5 12345')
+        for server_port in self.metrics_ports:
+            s = socket.create_connection(('127.0.0.1', server_port))
+            s.send(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                data = s.recv(100000)
+                if not data:
+                    break
+                response += data
+            s.close()
+            self.assertTrue(response.startswith(b'HTTP/1.0 200 OK'))
+            self.assertIn(b'task_queue_persistence_seconds_count', response)
+
+    def test_blocking_get(self):
+        waiting_connection = self.connect()
+        waiting_connection.send(b'GET 5 5')
+        time.sleep(0.2)
+        task_id = self.send(b'ADD 5 5 12345')
+        self.assertEqual(task_id + b' 5 12345', waiting_connection.recv(1000))
+        waiting_connection.close()
+        self.assertEqual(b'YES', self.send(b'ACK 5 ' + task_id))
+
+        start_time = time.time()
+        self.assertEqual(b'NONE', self.send(b'GET 5 0.3'))
+        self.assertGreaterEqual(time.time() - start_time, 0.3)
+
+    def test_pipeline(self):
+        s = self.connect()
+        s.send(b'PIPELINE\n')
+        self.assertEqual([b'OK'], self.recv_frames(s, 1))
+
+        s.send(b'13\nADD 4 5 12345' b'13\nADD 4 5 67890' b'5\nGET 4')
+        first_task_id, second_task_id, first_task = self.recv_frames(s, 3)
+        self.assertEqual(first_task_id + b' 5 12345', first_task)
+
+        commands = [b'ACK 4 ' + first_task_id, b'IN 4 ' + first_task_id, b'GET 4', b'ACK 4 ' + second_task_id]
+        s.send(b''.join(str(len(command)).encode() + b'\n' + command for command in commands))
+        self.assertEqual([b'YES', b'NO', second_task_id + b' 5 67890', b'YES'], self.recv_frames(s, 4))
+        s.close()
+
+    def test_pipeline_errors(self):
+        s = self.connect()
+        s.send(b'PIPELINE\n')
+        self.assertEqual([b'OK'], self.recv_frames(s, 1))
+
+        commands = [b'ADD 8 1 x', b'ADD 8 color=red 1 y', b'IN 8 0-1']
+        s.send(b''.join(str(len(command)).encode() + b'\n' + command for command in commands))
+        task_id, error, in_response = self.recv_frames(s, 3)
+        self.assertTrue(error.startswith(b'ERROR'))
+        self.assertEqual(b'NO', in_response)
+
+        # the connection is still open after the error
+        s.send(b'5\nGET 8' + b'5\nFOO 8')
+        task, error = self.recv_frames(s, 2)
+        self.assertEqual(task_id + b' 1 x', task)
+        self.assertTrue(error.startswith(b'ERROR'))
+        s.send(str(len(b'ACK 8 ' + task_id)).encode() + b'\nACK 8 ' + task_id)
+        self.assertEqual([b'YES'], self.recv_frames(s, 1))
+        s.close()
+
+    def recv_frames(self, s, count):
+        data = b''
+        frames = []
+        while len(frames) < count:
+            data += s.recv(1000000)
+            while b'\n' in data:
+                header, rest = data.split(b'\n', 1)
+                if len(rest) < int(header):
+                    break
+                frames.append(rest[:int(header)])
+                data = rest[int(header):]
+        return frames
+
+
+class ServerShardsTest(ServerAsyncTest):
+    """ queues partitioned between worker processes """
+    def setUp(self):
+        self.backup_dir = tempfile.TemporaryDirectory()
+        self.server = subprocess.Popen(['python', 'server.py', '--workers', '3', '--metrics_port', '5600',
+                                        '--backup_path', os.path.join(self.backup_dir.name, 'backup.json')])
+        self.metrics_ports = [5600, 5601, 5602]
+        # даем серверу время на запуск
+        time.sleep(1)
+
+    def tearDown(self):
+        super().tearDown()
+        self.backup_dir.cleanup()
+
+    def test_many_queues(self):
+        task_ids = {}
+        for queue_name in range(20):
+            task_ids[queue_name] = self.send('ADD q{} 1 {}'.format(queue_name, queue_name % 10).encode())
+        for queue_name, task_id in task_ids.items():
+            self.assertEqual(task_id + ' 1 {}'.format(queue_name % 10).encode(),
+                             self.send('GET q{}'.format(queue_name).encode()))
+            self.assertEqual(b'YES', self.send('ACK q{} '.format(queue_name).encode() + task_id))
+
+    def test_forwarding_errors(self):
+        # commands for queues of other shards share one connection between shards
+        for queue_name in range(10):
+            self.assertTrue(self.send('ADD q{} color=red 1 x'.format(queue_name).encode()).startswith(b'ERROR'))
+            task_id = self.send('ADD q{} 1 x'.format(queue_name).encode())
+            self.assertEqual(task_id + b' 1 x', self.send('GET q{}'.format(queue_name).encode()))
+            self.assertEqual(b'YES', self.send('ACK q{} '.format(queue_name).encode() + task_id))
+
+
+class ServerReplicationTest(TestCase):
+    """ primary and hot standby in two processes """
+    primary_args = []
+
+    def setUp(self):
+        self.backup_dir = tempfile.TemporaryDirectory()
+        self.primary = subprocess.Popen(['python', 'server.py', '5555', '--replication_port', '5590',
+                                         '--replica_buffer_size', '2000000',
+                                         '--backup_path', os.path.join(self.backup_dir.name, 'primary.json')] +
+                                        self.primary_args)
+        time.sleep(0.5)
+        self.standby = self.start_standby(5556)
+        self.servers = [self.primary, self.standby]
+
+    def start_standby(self, port):
+        standby = subprocess.Popen(['python', 'server.py', str(port), '--replicate_from', '5590', '--async',
+                                    '--backup_path', os.path.join(self.backup_dir.name, '{}.json'.format(port))])
+        time.sleep(0.5)
+        return standby
+
+    def tearDown(self):
+        for server in self.servers:
+            server.terminate()
+            server.wait()
+        self.backup_dir.cleanup()
+
+    def send(self, port, command):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # a primary waiting for a standby would never answer
+        s.settimeout(10)
+        s.connect(('127.0.0.1', port))
+        s.send(command)
+        data = s.recv(1000000)
+        s.close()
+        return data
+
+    def test_takeover(self):
+        first_task_id = self.send(5555, b'ADD 1 5 12345')
+        second_task_id = self.send(5555, b'ADD 1 5 67890')
+        third_task_id = self.send(5555, b'ADD 1 5 abcde')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(5555, b'GET 1'))
+        self.assertEqual(b'YES', self.send(5555, b'ACK 1 ' + second_task_id))
+
+        self.primary.terminate()
+        self.primary.wait()
+        time.sleep(0.5)
+
+        self.assertEqual(b'YES', self.send(5556, b'IN 1 ' + first_task_id))
+        self.assertEqual(b'NO', self.send(5556, b'IN 1 ' + second_task_id))
+        self.assertEqual(third_task_id + b' 5 abcde', self.send(5556, b'GET 1'))
+        self.assertLess(third_task_id, self.send(5556, b'ADD 1 5 fghij'))
+
+    def test_slow_standby(self):
+        first_task_id = self.send(5555, b'ADD 1 5 12345')
+        slow_standby = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow_standby.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow_standby.connect(('127.0.0.1', 5590))
+
+        # the slow standby reads nothing, the primary goes on and disconnects it
+        payload = b'x' * 100000
+        task_ids = [self.send(5555, b'ADD 2 100000 ' + payload) for _ in range(100)]
+        self.assertIn(b'task_queue_replicas 1', self.send(5555, b'STATS'))
+        slow_standby.close()
+
+        # a standby connected later gets the state with the tasks added before it
+        self.servers.append(self.start_standby(5557))
+        self.primary.terminate()
+        self.primary.wait()
+        time.sleep(0.5)
+        for port in [5556, 5557]:
+            self.assertEqual(b'YES', self.send(port, b'IN 1 ' + first_task_id))
+            self.assertEqual(b'YES', self.send(port, b'IN 2 ' + task_ids[-1]))
+
+
+    def test_dropped_standby_connects_again(self):
+        first_task_id = self.send(5555, b'ADD 1 5 12345')
+        # the stopped standby does not read, the primary drops it when its buffer is full
+        self.standby.send_signal(signal.SIGSTOP)
+        payload = b'x' * 100000
+        task_ids = [self.send(5555, b'ADD 2 100000 ' + payload) for _ in range(200)]
+        self.assertIn(b'task_queue_replicas 0', self.send(5555, b'STATS'))
+        self.standby.send_signal(signal.SIGCONT)
+        time.sleep(1)
+
+        # the primary is alive, so the standby follows it again instead of taking over
+        self.assertIn(b'task_queue_replicas 1', self.send(5555, b'STATS'))
+        with self.assertRaises(ConnectionRefusedError):
+            self.send(5556, b'IN 1 ' + first_task_id)
+
+        self.primary.terminate()
+        self.primary.wait()
+        time.sleep(0.5)
+        self.assertEqual(b'YES', self.send(5556, b'IN 1 ' + first_task_id))
+        self.assertEqual(b'YES', self.send(5556, b'IN 2 ' + task_ids[-1]))
+        self.assertLess(task_ids[-1], self.send(5556, b'ADD 1 1 z'))
+
+class ServerAsyncReplicationTest(ServerReplicationTest):
+    """ asyncio primary """
+    primary_args = ['--async']
+
+
+class ServerRecoveryTest(TestCase):
+    """ snapshot and journal replay testing """
+    def setUp(self):
+        self.backup_dir = tempfile.TemporaryDirectory()
+        self.backup_path = os.path.join(self.backup_dir.name, 'backup.json')
+
+    def tearDown(self):
+        self.backup_dir.cleanup()
+
+    def restart(self, server, **kwargs):
+        server.journal.close()
+        return Server(backup_file_path=self.backup_path, **kwargs)
+
+    def send(self, server, command):
+        response = server.process_task(command)
+        server.write_file()
+        return b''.join(response_chunks(response))
+
+    def test_journal_replay(self):
+        server = Server(backup_file_path=self.backup_path)
+        first_task_id = self.send(server, b'ADD 1 5 12345')
+        second_task_id = self.send(server, b'ADD 1 5 67890')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(server, b'GET 1'))
+        self.assertFalse(os.path.exists(self.backup_path))
+
+        server = self.restart(server)
+        self.assertEqual(second_task_id + b' 5 67890', self.send(server, b'GET 1'))
+        self.assertEqual(b'NONE', self.send(server, b'GET 1'))
+        self.assertEqual(b'YES', self.send(server, b'ACK 1 ' + first_task_id))
+
+        server = self.restart(server)
+        self.assertEqual(b'NO', self.send(server, b'IN 1 ' + first_task_id))
+        self.assertEqual(b'YES', self.send(server, b'IN 1 ' + second_task_id))
+
+    def test_stats_label_escaping(self):
+        server = Server(backup_file_path=self.backup_path)
+        self.send(server, b'ADD a"b\\c 1 x')
+        self.assertIn(b'task_queue_tasks{queue="a\\"b\\\\c"} 1', self.send(server, b'STATS'))
+
+    def test_log_sample_rate(self):
+        for log_sample_rate in [0, -0.5, 1.5, float('nan')]:
+            with self.assertRaises(ValueError):
+                Server(backup_file_path=self.backup_path, log_sample_rate=log_sample_rate)
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_sample_rate(str(log_sample_rate))
+
+        server = Server(backup_file_path=self.backup_path, log_sample_rate=0.6)
+        # the logger is not configured, records are caught by assertLogs
+        server._log_requests = True
+        with self.assertLogs('task_queue', 'INFO') as logs:
+            for _ in range(10):
+                self.send(server, b'IN 1 a')
+        self.assertEqual(6, len(logs.records))
+
+    def test_timed_out_waiters_are_removed(self):
+        server = Server(backup_file_path=self.backup_path)
+        self.assertEqual(b'NONE', asyncio.run(server._get_blocking(b'GET 1 0.05', ['get', b'1', b'0.05'])))
+        self.assertEqual({}, server._task_waiters)
+
+        async def wait_and_add():
+            waiting_get = asyncio.ensure_future(server._get_blocking(b'GET 1 5', ['get', b'1', b'5']))
+            await asyncio.sleep(0.05)
+            self.send(server, b'ADD 1 1 x')
+            return await waiting_get
+
+        self.assertTrue(b''.join(response_chunks(asyncio.run(wait_and_add()))).endswith(b' 1 x'))
+        self.assertEqual({}, server._task_waiters)
+
+    def test_other_shards_count(self):
+        queue_name = next('q{}'.format(number) for number in range(100)
+                          if get_queue_shard_index('q{}'.format(number), 2) == 0 and
+                          get_queue_shard_index('q{}'.format(number), 3) != 0)
+        shard_backup_path = get_shard_backup_path(self.backup_path, 0)
+        server = Server(backup_file_path=shard_backup_path, shard_index=0, shards_count=2)
+        self.send(server, 'ADD {} 1 x'.format(queue_name).encode())
+        server.journal.close()
+
+        with self.assertRaises(ValueError):
+            Server(backup_file_path=shard_backup_path, shard_index=0, shards_count=3)
+
+        server = Server(backup_file_path=shard_backup_path, shard_index=0, shards_count=2)
+        server.write_snapshot()
+        server.journal.close()
+        with self.assertRaises(ValueError):
+            Server(backup_file_path=shard_backup_path, shard_index=0, shards_count=3)
+
+        check_backup_layout(self.backup_path, 2)
+        for shards_count in [1, 3]:
+            with self.assertRaises(ValueError):
+                check_backup_layout(self.backup_path, shards_count)
+
+    def test_compaction(self):
+        server = Server(backup_file_path=self.backup_path, compaction_threshold=3)
+        first_task_id = self.send(server, b'ADD 1 5 12345')
+        second_task_id = self.send(server, b'ADD 1 5 67890')
+        self.send(server, b'GET 1')
+        self.assertTrue(os.path.exists(self.backup_path))
+        self.assertEqual(0, os.path.getsize(server.journal_file_path))
+        self.assertEqual(b'YES', self.send(server, b'ACK 1 ' + first_task_id))
+
+        server = self.restart(server, compaction_threshold=3)
+        self.assertEqual(b'NO', self.send(server, b'IN 1 ' + first_task_id))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(server, b'GET 1'))
+
+    def test_add_options(self):
+        server = Server(backup_file_path=self.backup_path)
+        low_task_id = self.send(server, b'ADD 1 1 a')
+        delayed_task_id = self.send(server, 'ADD 1 priority=9 not_before={} 1 b'.format(time.time() + 0.3).encode())
+        high_task_ids = self.send(server, b'MADD 1 priority=2 2 1 c 1 d').split()
+
+        server = self.restart(server)
+        self.assertEqual(high_task_ids[0] + b' 1 c', self.send(server, b'GET 1'))
+        self.assertEqual(high_task_ids[1] + b' 1 d', self.send(server, b'GET 1'))
+        self.assertEqual(low_task_id + b' 1 a', self.send(server, b'GET 1'))
+        self.assertEqual(b'NONE', self.send(server, b'GET 1'))
+        time.sleep(0.3)
+        self.assertEqual(delayed_task_id + b' 1 b', self.send(server, b'GET 1'))
+        with self.assertRaises(ValueError):
+            self.send(server, b'ADD 1 color=red 1 e')
+
+    def test_task_ids(self):
+        server = Server(backup_file_path=self.backup_path, compaction_threshold=4)
+        task_ids = [self.send(server, b'ADD 1 1 a') for _ in range(3)]
+        self.send(server, b'GET 1')
+
+        # after the compaction the journal is empty, the sequence comes from the snapshot
+        server = self.restart(server, compaction_threshold=4)
+        task_ids += self.send(server, b'MADD 1 2 1 b 1 c').split()
+        self.assertEqual(sorted(task_ids), task_ids)
+        self.assertEqual(len(task_ids), len(set(task_ids)))
+        self.assertTrue(all(task_id.startswith(b'0-') for task_id in task_ids))
+
+    def test_lazy_snapshot(self):
+        server = Server(backup_file_path=self.backup_path)
+        task_ids = {queue_name: self.send(server, 'ADD {} 1 {}'.format(queue_name, queue_name).encode())
+                    for queue_name in ['1', '2', '3']}
+        self.send(server, b'GET 2')
+        server.write_snapshot()
+
+        server = self.restart(server)
+        self.assertEqual(3, server.queue_dict.unloaded_count())
+        self.assertIn(b'task_queue_in_flight_tasks{queue="2"} 1', self.send(server, b'STATS'))
+        self.assertIn(b'task_queue_recovery_seconds', self.send(server, b'STATS'))
+        self.assertEqual(task_ids['1'] + b' 1 1', self.send(server, b'GET 1'))
+        self.assertEqual(2, server.queue_dict.unloaded_count())
+
+        # queues which are not loaded are copied to the new snapshot as they are
+        server.write_snapshot()
+        server = self.restart(server)
+        self.assertEqual(b'NONE', self.send(server, b'GET 2'))
+        self.assertEqual(b'YES', self.send(server, b'IN 2 ' + task_ids['2']))
+        self.assertEqual(task_ids['3'] + b' 1 3', self.send(server, b'GET 3'))
+
+    def test_quotas(self):
+        server = Server(backup_file_path=self.backup_path, max_queue_tasks=2, max_bytes=10)
+        task_id = self.send(server, b'ADD 1 3 abc')
+        self.send(server, b'ADD 1 3 def')
+        self.assertEqual(b'FULL', self.send(server, b'ADD 1 1 g'))
+        self.assertEqual(b'FULL', self.send(server, b'MADD 2 2 3 abc 3 def'))
+        # bytes of commands being received on other connections are reserved as well
+        server._receiving_bytes = 4
+        self.assertEqual(b'FULL', self.send(server, b'ADD 2 1 g'))
+        server._receiving_bytes = 0
+        self.assertNotEqual(b'FULL', self.send(server, b'ADD 2 1 g'))
+
+        server = self.restart(server, max_queue_tasks=2, max_bytes=10)
+        self.assertEqual(b'FULL', self.send(server, b'ADD 2 4 hijk'))
+        self.assertEqual(b'YES', self.send(server, b'ACK 1 ' + task_id))
+        self.assertNotEqual(b'FULL', self.send(server, b'ADD 2 4 hijk'))
+        self.assertIn(b'task_queue_rejected_commands_total 1', self.send(server, b'STATS'))
+
+    def test_json_backup(self):
+        with open(self.backup_path, 'w', encoding='utf8') as backup_file:
+            json.dump({'queue_dict': {'1': [{'id': 'abc', 'length': '5', 'data': list(b'12345'), 'is_available': False},
+                                            {'id': 'def', 'length': '5', 'data': list(b'67890'), 'is_available': True}]},
+                       'timeouts_list': [{'queue': '1', 'id': 'abc', 'timestamp': time.time()}]}, backup_file)
+
+        server = Server(backup_file_path=self.backup_path, compaction_threshold=1)
+        self.assertEqual(b'def 5 67890', self.send(server, b'GET 1'))
+
+        server = self.restart(server)
+        self.assertEqual(b'NONE', self.send(server, b'GET 1'))
+        self.assertEqual(b'YES', self.send(server, b'IN 1 abc'))
+
+    def test_payloads_over_memory_limit(self):
+        server = Server(backup_file_path=self.backup_path, payload_memory_limit=5)
+        first_task_id = self.send(server, b'ADD 1 5 12345')
+        second_task_id = self.send(server, b'ADD 1 5 67890')
+        self.assertEqual(1, len(server.payload_store.segments))
+
+        server = self.restart(server, payload_memory_limit=5)
+        self.assertEqual(first_task_id + b' 5 12345', self.send(server, b'GET 1'))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(server, b'GET 1'))
+
+    def test_payloads_do_not_keep_commands(self):
+        server = Server(backup_file_path=self.backup_path)
+        task_ids = self.send(server, b'MADD 1 10 ' + b' '.join([b'100000 ' + b'x' * 100000] * 10)).split()
+        for task_id in task_ids[:9]:
+            self.assertEqual(b'YES', self.send(server, b'ACK 1 ' + task_id))
+
+        task = server.queue_dict['1'].get(task_ids[9].decode('utf8'))
+        self.assertIsInstance(task['data'], bytes)
+        self.assertEqual(100000, server.payload_store.memory_size)
+
+    def test_torn_journal_tail(self):
+        server = Server(backup_file_path=self.backup_path)
+        task_id = self.send(server, b'ADD 1 5 12345')
+        server.journal.close()
+        with open(server.journal_file_path, 'ab') as journal_file:
+            journal_file.write(b'\x00\x00\x00\x01{"op": "ack", "queue"')
+
+        server = Server(backup_file_path=self.backup_path)
+        self.assertEqual(task_id + b' 5 12345', self.send(server, b'GET 1'))
+
+        server = self.restart(server)
+        self.assertEqual(b'NONE', self.send(server, b'GET 1'))
+        self.assertEqual(b'YES', self.send(server, b'ACK 1 ' + task_id))
+
+    def test_empty_payload(self):
+        server = Server(backup_file_path=self.backup_path)
+        task_id = self.send(server, b'ADD 1 0 ')
+
+        server = self.restart(server)
+        self.assertEqual(task_id + b' 0 ', self.send(server, b'GET 1'))
+        server.write_snapshot()
+
+        server = self.restart(server)
+        self.assertEqual(b'YES', self.send(server, b'ACK 1 ' + task_id))
+
+    def test_binary_payload(self):
+        server = Server(backup_file_path=self.backup_path)
+        task_id = self.send(server, b'ADD Queue 10 Ab \n\x00 cD\tx')
+        self.assertEqual(b'YES', self.send(server, b'IN queue ' + task_id.upper()))
+
+        server = self.restart(server)
+        self.assertEqual(task_id + b' 10 Ab \n\x00 cD\tx', self.send(server, b'GET QUEUE'))
+
+
+class ProtocolTest(TestCase):
+    """ command parsing from partially received data """
+    def test_partial_commands(self):
+        command = b'MADD q 2 3 a b 1 \n'
+        for size in range(len(command)):
+            self.assertIsNone(parse_command(command[:size]), command[:size])
+
+        arguments, command_size = parse_command(command + b'\nGET q')
+        self.assertEqual(len(command) + 1, command_size)
+        self.assertEqual(['madd', b'q', b'2'], arguments[:3])
+        self.assertEqual([(b'3', b'a b'), (b'1', b'\n')], [(length, bytes(data)) for length, data in arguments[3:]])
+
+    def test_last_token_without_terminator(self):
+        self.assertIsNone(parse_command(b'GET q'))
+        self.assertEqual((['get', b'q'], 5), parse_command(b'GET q', at_end=True))
+        self.assertEqual((['get', b'q'], 5), parse_command(b'GET q', is_drained=True))
+        # the rest of the arguments is still to come
+        self.assertIsNone(parse_command(b'ACK q', is_drained=True))
+        self.assertIsNone(parse_command(b'GE', is_drained=True))
+        self.assertEqual((['get', b'q', b'1.5'], 11), parse_command(b'get q 1.5\r\n'))
+        self.assertIsNone(parse_command(b'ACK q a'))
+        # the payload length tells where ADD ends
+        self.assertEqual(b'x', bytes(parse_command(b'ADD q 1 x')[0][2][1]))
+        with self.assertRaises(ValueError):
+            parse_command(b'ACK q', at_end=True)
+
+    def test_wrong_commands(self):
+        for command in [b'FOO q', b'GET q 1 2\n', b'ADD q x abc', b'GET\n', b'MACK q 2 a\n']:
+            with self.assertRaises(ValueError):
+                parse_command(command)
+
+    def test_command_reader(self):
+        command_reader = CommandReader()
+        command_reader.feed(b'IN q a\nPIPE')
+        self.assertEqual((b'IN q a\n', ['in', b'q', b'a']), command_reader.next_command())
+        self.assertIsNone(command_reader.next_command())
+        command_reader.feed(b'LINE\n5\n')
+        self.assertEqual('pipeline', command_reader.next_command()[1][0])
+        self.assertEqual(b'5\n', command_reader.rest())
+
+    def test_command_split_between_chunks(self):
+        command_reader = CommandReader()
+        command_reader.feed(b'GET my')
+        self.assertIsNone(command_reader.next_command())
+        command_reader.feed(b'queue')
+        self.assertEqual((b'GET myqueue', ['get', b'myqueue']), command_reader.next_command(is_drained=True))
+        self.assertIsNone(command_reader.next_command(at_end=True))
+
+        command_reader.feed(b'ADD q 10 12345')
+        self.assertIsNone(command_reader.next_command(is_drained=True))
+        with self.assertRaises(ValueError):
+            command_reader.next_command(at_end=True)
+
+    def test_payload_is_parsed_once_complete(self):
+        command_reader = CommandReader()
+        command_reader.feed(b'ADD q 100000 ')
+        self.assertIsNone(command_reader.next_command())
+        for _ in range(99):
+            command_reader.feed(b'x' * 1000)
+            self.assertIsNone(command_reader.next_command())
+            # chunks of the payload are not joined before the last one
+            self.assertGreater(len(command_reader._chunks), 0)
+        command_reader.feed(b'x' * 1000)
+        command, arguments = command_reader.next_command()
+        self.assertEqual(b'x' * 100000, bytes(arguments[2][1]))
+
+
+class TaskQueueTest(TestCase):
+    """ delivery order of the indexed queue """
+    def take_first(self, task_queue):
+        task = task_queue.first_available()
+        task_queue.take(task['id'])
+        return task['id']
+
+    def test_redelivery_keeps_adding_order(self):
+        task_queue = TaskQueue()
+        for task_id in ['a', 'b', 'c']:
+            task_queue.add(task_id, '1', [])
+
+        self.assertEqual('a', self.take_first(task_queue))
+        self.assertEqual('b', self.take_first(task_queue))
+        task_queue.release('b')
+        task_queue.release('a')
+        self.assertEqual('a', self.take_first(task_queue))
+
+        self.assertTrue(task_queue.remove('b'))
+        self.assertFalse(task_queue.remove('b'))
+        self.assertEqual('c', self.take_first(task_queue))
+        self.assertIsNone(task_queue.first_available())
+        self.assertIn('a', task_queue)
+
+    def test_priorities_and_delays(self):
+        task_queue = TaskQueue()
+        task_queue.add('low', '1', [])
+        task_queue.add('high', '1', [], priority=5)
+        ready_time = time.time() + 1000
+        task_queue.add('delayed', '1', [], priority=10, not_before=ready_time)
+        task_queue.add('high2', '1', [], priority=5)
+
+        self.assertEqual('high', self.take_first(task_queue))
+        self.assertEqual('high2', self.take_first(task_queue))
+        task_queue.release('high')
+        self.assertEqual(ready_time, task_queue.next_ready_time())
+        self.assertEqual('delayed', task_queue.first_available(now=ready_time)['id'])
+        task_queue.take('delayed')
+        self.assertEqual('high', self.take_first(task_queue))
+        self.assertEqual('low', self.take_first(task_queue))
+
+    def test_list_round_trip(self):
+        task_queue = TaskQueue()
+        for task_id in ['a', 'b', 'c']:
+            task_queue.add(task_id, '1', [])
+        self.take_first(task_queue)
+
+        restored_queue = TaskQueue.from_list(task_queue.to_list())
+        self.assertEqual({'a'}, restored_queue.in_flight)
+        self.assertEqual('b', restored_queue.first_available()['id'])
+
+    def test_restore_while_reading(self):
+        task_queue = TaskQueue()
+        for task_id in ['a', 'b', 'c']:
+            task_queue.add(task_id, '2', b'xy')
+
+        payload_store = PayloadStore()
+
+        def read_tasks():
+            for restored_count, task in enumerate(task_queue.to_list()):
+                # payloads of the tasks read before are in the store already
+                self.assertEqual(2 * restored_count, payload_store.memory_size)
+                yield task
+
+        restored_queue = TaskQueue.from_list(read_tasks(), payload_store)
+        self.assertEqual(3, len(restored_queue))
+
+
+class ExpirySchedulerTest(TestCase):
+    """ expiry order and cancelling """
+    def test_pop_expired(self):
+        scheduler = ExpiryScheduler()
+        scheduler.schedule('1', 'a', 10)
+        scheduler.schedule('1', 'b', 20)
+        scheduler.schedule('2', 'c', 15)
+        scheduler.schedule('1', 'd', 12)
+        scheduler.cancel('1', 'd')
+
+        self.assertEqual([], scheduler.pop_expired(5))
+        self.assertEqual([('1', 'a'), ('2', 'c')], scheduler.pop_expired(15))
+        self.assertEqual(1, len(scheduler))
+
+        # the task was given again, the old deadline does not count anymore
+        scheduler.schedule('1', 'b', 30)
+        self.assertEqual([], scheduler.pop_expired(25))
+        self.assertEqual([('1', 'b')], scheduler.pop_expired(30))
+
+    def test_list_round_trip(self):
+        scheduler = ExpiryScheduler()
+        scheduler.schedule('1', 'b', 20)
+        scheduler.schedule('1', 'a', 10)
+
+        restored_scheduler = ExpiryScheduler.from_list(scheduler.to_list())
+        self.assertEqual([('1', 'a'), ('1', 'b')], restored_scheduler.pop_expired(20))
+
+
+class PayloadStoreTest(TestCase):
+    """ spilling payloads to memory-mapped segments """
+    def setUp(self):
+        self.segments_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.segments_dir.cleanup()
+
+    def test_spill_and_reclaim(self):
+        payload_store = PayloadStore(self.segments_dir.name, memory_limit=4, segment_size=8)
+        in_memory = payload_store.put(b'1234')
+        first_spilled = payload_store.put(b'56789')
+        second_spilled = payload_store.put(b'abcdef')
+
+        self.assertEqual(b'1234', bytes(payload_store.get(in_memory)))
+        self.assertEqual(b'56789', bytes(payload_store.get(first_spilled)))
+        self.assertEqual(b'abcdef', bytes(payload_store.get(second_spilled)))
+        self.assertEqual(2, len(os.listdir(self.segments_dir.name)))
+
+        payload_store.release(first_spilled)
+        self.assertEqual(1, len(os.listdir(self.segments_dir.name)))
+        payload_store.release(in_memory)
+        self.assertEqual(0, payload_store.memory_size)
+        self.assertEqual(b'7', bytes(payload_store.get(payload_store.put(b'7'))))
+
+    def test_other_files_are_kept(self):
+        os.mkdir(os.path.join(self.segments_dir.name, 'nested'))
+        for file_name in ['notes.txt', '3.segment']:
+            with open(os.path.join(self.segments_dir.name, file_name), 'w') as other_file:
+                other_file.write('data')
+
+        PayloadStore(self.segments_dir.name, memory_limit=4)
+        self.assertEqual(['nested', 'notes.txt'], sorted(os.listdir(self.segments_dir.name)))